@@ -0,0 +1,566 @@
+#!/usr/bin/env /home/marpauli/.cache/pypoetry/virtualenvs/syncsuite-HX8knUdy-py3.12/bin/python
+
+"""
+Benchmark of the hot paths of SyncSuite scripts on synthetic trees.
+
+For every tree size, synthetic local tree of mixed size files (with empty
+remote counterpart dirs), file map and config are generated in work dir.
+Then rsync_to_remote (cold sync of all files and no-op re-run),
+create_path_sync and 'file_map -a' are run against them (remote files
+missing after rsync_to_remote, e.g. when it is not benchmarked, are seeded
+with copies of local ones, as both search the remote tree), with ssh replaced
+by a shim executing remote commands locally after injected latency (or
+wrapping real ssh with -rs, when local sshd is available).
+Throughput, per-file latency and number of spawned ssh/rsync processes are
+reported for every run, so regressions show up as numbers. Startup of the
+scripts is measured too, together with import time from 'python -X
+importtime' and the slowest top level imports.
+
+Scripts are run from their copy in work dir, so manifest, logs and caches
+of the benchmark never mix with the ones of the real syncsuite.
+"""
+
+import getpass
+import json
+import os
+import shutil
+import stat
+import sys
+from argparse import RawDescriptionHelpFormatter
+from pathlib import Path
+from random import Random
+from subprocess import DEVNULL, PIPE, run
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import common
+from common import (
+    BLD,
+    CB,
+    GB,
+    RB,
+    RST,
+    CustomArgParser,
+    SSHConnection,
+    log_path,
+    metrics_filename,
+    percentile,
+    write_yaml,
+)
+
+script_root = Path(__file__).resolve().parent
+# copy of scripts run by the benchmark (set in main)
+scripts_dir = script_root
+
+# (share of files, min size, max size) in bytes
+SIZE_CLASSES = [(0.6, 512, 4096), (0.35, 4096, 65536), (0.05, 65536, 524288)]
+EXTENSIONS = [".py", ".png", ".yaml", ".json", ".js", ".css"]
+FILES_PER_DIR = 50
+DIRS_PER_DIR = 10
+
+SSH_SHIM = """#!/bin/sh
+# ssh stand-in: runs remote command locally after injected latency
+echo ssh >> "$SYNCSUITE_BENCH_CALLS"
+if [ -n "$SYNCSUITE_BENCH_SSH" ]; then
+    exec "$SYNCSUITE_BENCH_SSH" "$@"
+fi
+sock=""
+op=""
+master=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -S) sock="$2"; shift 2 ;;
+        -O) op="$2"; shift 2 ;;
+        -M) master=1; shift ;;
+        -[bcDEeFIiJLlmOoPpQRWw]) shift 2 ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+shift
+case "$op" in
+    check) [ -n "$sock" ] && [ -e "$sock" ]; exit $? ;;
+    exit) rm -f "$sock"; exit 0 ;;
+esac
+# new connection costs ~3 round trips, multiplexed session just one
+if [ -z "$sock" ] || [ ! -e "$sock" ]; then
+    sleep "$SYNCSUITE_BENCH_HANDSHAKE"
+fi
+if [ -n "$master" ]; then
+    touch "$sock"
+    exit 0
+fi
+sleep "$SYNCSUITE_BENCH_LATENCY"
+exec sh -c "$*"
+"""
+
+RSYNC_SHIM = """#!/bin/sh
+echo rsync >> "$SYNCSUITE_BENCH_CALLS"
+exec "$SYNCSUITE_BENCH_RSYNC" "$@"
+"""
+
+# setup arg parser
+help_message = """
+    Benchmark rsync_to_remote, create_path_sync, 'file_map -a' and startup
+    of the scripts on synthetic trees (local sshd or shim ssh with injected latency)."""
+cap = CustomArgParser(
+    description=help_message,
+    formatter_class=RawDescriptionHelpFormatter,
+)
+cap.add_argument(
+    "-s",
+    "--sizes",
+    default="10,1000,10000",
+    help="Comma separated numbers of files in generated trees",
+)
+cap.add_argument(
+    "-t",
+    "--tools",
+    default="rsync_to_remote,create_path_sync,file_map,startup",
+    help="Comma separated tools to benchmark",
+)
+cap.add_argument(
+    "-lt",
+    "--latency",
+    type=float,
+    default=0.005,
+    help="Injected round trip latency of shim ssh in seconds",
+)
+cap.add_argument(
+    "-rs",
+    "--real_ssh",
+    action="store_true",
+    help="Use real ssh to local sshd (key auth) instead of the shim",
+)
+cap.add_argument("-p", "--port", default="22", help="Port of local sshd")
+cap.add_argument(
+    "-tr",
+    "--transport",
+    choices=["auto", "rsync", "tar", "agent"],
+    default="auto",
+    help="Transport passed to rsync_to_remote",
+)
+cap.add_argument(
+    "-j", "--jobs", default="1", help="Jobs passed to rsync_to_remote"
+)
+cap.add_argument(
+    "-a",
+    "--add_samples",
+    type=int,
+    default=5,
+    help="Number of 'file_map -a' runs per tree",
+)
+cap.add_argument(
+    "-ss",
+    "--startup_samples",
+    type=int,
+    default=10,
+    help="Number of timed runs per script in startup benchmark",
+)
+cap.add_argument("--seed", type=int, default=0, help="Seed of generated trees")
+cap.add_argument(
+    "-w",
+    "--work_dir",
+    help="Keep generated trees in 'syncsuite-bench' subdir of this dir "
+    "(temporary dir by default)",
+)
+cap.add_argument("-o", "--output", help="Append results as JSON lines here")
+
+args = cap.parse_args()
+
+sizes = [int(size) for size in args.sizes.split(",")]
+tools = args.tools.split(",")
+real_rsync = shutil.which("rsync")
+real_ssh = shutil.which("ssh")
+if (
+    "rsync_to_remote" in tools
+    and args.transport not in ["tar", "agent"]
+    and not real_rsync
+):
+    cap.error(
+        f"{RB}rsync not found! Use '-tr tar', '-tr agent' or install it.{RST}"
+    )
+if args.real_ssh and not real_ssh:
+    cap.error(f"{RB}ssh not found!{RST}")
+
+
+def get_file_size(rng: Random) -> int:
+    share = rng.random()
+    for class_share, min_size, max_size in SIZE_CLASSES:
+        if share < class_share:
+            return rng.randint(min_size, max_size)
+        share -= class_share
+    return SIZE_CLASSES[-1][2]
+
+
+def get_rel_dir(num: int) -> Path:
+    """
+    Place files FILES_PER_DIR per dir in tree of DIRS_PER_DIR wide levels.
+    """
+    dir_num = num // FILES_PER_DIR
+    parts = []
+    while True:
+        parts.append(f"d{dir_num % DIRS_PER_DIR:02}")
+        dir_num //= DIRS_PER_DIR
+        if not dir_num:
+            break
+    return Path(*reversed(parts))
+
+
+def build_tree(tree_dir: Path, count: int, rng: Random) -> dict:
+    """
+    Generate local tree with files of mixed sizes, empty remote dirs
+    for all of them, config and file map (all files in single task).
+
+    :param tree_dir: Dir to generate the tree in.
+    :param count: Number of generated files.
+    :param rng: Random generator of file sizes and contents.
+    :return: Paths of generated tree and its total size.
+    """
+    source = tree_dir / "source"
+    remote = tree_dir / "remote"
+    config_dir = tree_dir / "config"
+    config_dir.mkdir(parents=True)
+    files = {}
+    total_size = 0
+    for num in range(count):
+        rel_dir = get_rel_dir(num)
+        (source / rel_dir).mkdir(parents=True, exist_ok=True)
+        (remote / rel_dir).mkdir(parents=True, exist_ok=True)
+        name = f"file{num:05}{EXTENSIONS[num % len(EXTENSIONS)]}"
+        size = get_file_size(rng)
+        (source / rel_dir / name).write_bytes(rng.randbytes(size))
+        files[num + 1] = [
+            (rel_dir / name).as_posix(),
+            (remote / rel_dir / name).as_posix(),
+        ]
+        total_size += size
+    # create_path_sync stores maps per git branch
+    git = ["git", "-C", source, "-c", "user.name=bench"]
+    git += ["-c", "user.email=bench@localhost"]
+    run(git + ["init", "-q"], check=True)
+    run(git + ["commit", "-q", "--allow-empty", "-m", "bench"], check=True)
+    write_yaml(config_dir / "file_map.yaml", {"bench": files})
+    write_yaml(
+        config_dir / "sync_conf.yaml",
+        {
+            "rsync": {
+                "host": "localhost" if args.real_ssh else "syncsuite-bench",
+                "hosts": [],
+                "username": getpass.getuser(),
+                "port": args.port,
+                "rsync_options": ["-rt", "-e", f"ssh -p {args.port}"],
+                "local_root_dir": source.as_posix(),
+                "persistent_ssh": True,
+                "control_persist": 20,
+                "batch_rsync": False,
+                "jobs": int(args.jobs),
+                "transport": args.transport,
+            },
+            "script": {
+                "VM_check_timeout": 0,
+                "result_timeout": 0,
+                "default_browse_dir": remote.as_posix(),
+                "date_format": "%Y-%m-%d %H:%M:%S",
+            },
+            "sync": {"sync_all": True, "task": None, "file_keys": []},
+            "services": {"restart_services": False, "services": [None]},
+        },
+    )
+    return {
+        "source": source,
+        "config": config_dir / "sync_conf.yaml",
+        "file_map": config_dir / "file_map.yaml",
+        "files": files,
+        "bytes": total_size,
+    }
+
+
+def install_scripts(target_dir: Path):
+    """
+    Copy scripts to target dir, so their manifest, logs and caches
+    (all relative to script root) are kept in work dir.
+    """
+    target_dir.mkdir(parents=True)
+    for script in script_root.glob("*.py"):
+        shutil.copy2(script, target_dir / script.name)
+
+
+def seed_remote(tree: dict):
+    """
+    Copy local files missing on remote to their remote paths, so searches
+    of the remote tree work without preceding rsync_to_remote run.
+    """
+    for source, target in tree["files"].values():
+        if not Path(target).exists():
+            shutil.copyfile(tree["source"] / source, target)
+
+
+def install_shims(bin_dir: Path) -> dict:
+    """
+    Write ssh (and rsync) shims counting their calls and return
+    environment for benchmarked scripts.
+    """
+    bin_dir.mkdir(parents=True)
+    shims = {"ssh": SSH_SHIM}
+    if real_rsync:
+        shims["rsync"] = RSYNC_SHIM
+    for name, content in shims.items():
+        (bin_dir / name).write_text(content)
+        (bin_dir / name).chmod((bin_dir / name).stat().st_mode | stat.S_IEXEC)
+    env = {
+        "PATH": f"{bin_dir}:{os.environ.get('PATH', '')}",
+        "SYNCSUITE_BENCH_CALLS": (bin_dir / "calls").as_posix(),
+        "SYNCSUITE_BENCH_LATENCY": str(args.latency),
+        "SYNCSUITE_BENCH_HANDSHAKE": str(3 * args.latency),
+        "SYNCSUITE_BENCH_RSYNC": real_rsync or "",
+        "SYNCSUITE_BENCH_SSH": real_ssh if args.real_ssh else "",
+    }
+    return os.environ | env
+
+
+def run_tool(name: str, cmd: list, env: dict, files: int, size: int) -> dict:
+    """
+    Run benchmarked script and measure it.
+
+    :param name: Name of the benchmark run.
+    :param cmd: Script and its arguments.
+    :param env: Environment with shims on PATH.
+    :param files: Number of files processed by the run.
+    :param size: Number of bytes processed by the run.
+    :return: Result of the run.
+    """
+    calls_file = Path(env["SYNCSUITE_BENCH_CALLS"])
+    calls_file.unlink(missing_ok=True)
+    metrics_file = scripts_dir / log_path.name / metrics_filename
+    metrics_offset = (
+        metrics_file.stat().st_size if metrics_file.exists() else 0
+    )
+    start = perf_counter()
+    process = run(
+        [sys.executable] + cmd,
+        cwd=scripts_dir,
+        env=env,
+        stdin=DEVNULL,
+        stdout=DEVNULL,
+        stderr=DEVNULL,
+    )
+    duration = perf_counter() - start
+    calls = calls_file.read_text().split() if calls_file.exists() else []
+    result = {
+        "run": name,
+        "files": files,
+        "bytes": size,
+        "duration": round(duration, 6),
+        "throughput": round(size / duration) if size else 0,
+        "latency": round(duration / files, 6) if files else 0.0,
+        "ssh_calls": calls.count("ssh"),
+        "rsync_calls": calls.count("rsync"),
+        "exit_status": process.returncode,
+    }
+    # per-file percentiles reported by the script itself
+    if metrics_file.exists():
+        with open(metrics_file) as f:
+            f.seek(metrics_offset)
+            summaries = [
+                record
+                for record in map(json.loads, f)
+                if record["op"] == "summary"
+            ]
+        if summaries:
+            result["p50"] = summaries[-1]["p50"]
+            result["p95"] = summaries[-1]["p95"]
+    return result
+
+
+def run_startup(name: str, cmd: list, env: dict) -> dict:
+    """
+    Measure startup of the script: import time reported by
+    'python -X importtime' (run also warms caches) and wall time
+    of repeated runs.
+
+    :param name: Name of the benchmark run.
+    :param cmd: Script and its arguments.
+    :param env: Environment with shims on PATH.
+    :return: Result of the run.
+    """
+    process = run(
+        [sys.executable, "-X", "importtime"] + cmd,
+        cwd=scripts_dir,
+        env=env,
+        stdin=DEVNULL,
+        stdout=DEVNULL,
+        stderr=PIPE,
+        text=True,
+    )
+    # top level imports: {module: cumulative time in seconds}
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit() and not module[1:].startswith(" "):
+            imports[module.strip()] = int(cumulative) / 1e6
+    durations = []
+    for _ in range(args.startup_samples):
+        start = perf_counter()
+        run(
+            [sys.executable] + cmd,
+            cwd=scripts_dir,
+            env=env,
+            stdin=DEVNULL,
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        durations.append(perf_counter() - start)
+    duration = percentile(durations, 50)
+    return {
+        "run": name,
+        "files": 1,
+        "bytes": 0,
+        "duration": round(duration, 6),
+        "throughput": 0,
+        "latency": round(duration, 6),
+        "p50": round(duration, 6),
+        "p95": round(percentile(durations, 95), 6),
+        "ssh_calls": 0,
+        "rsync_calls": 0,
+        "exit_status": process.returncode,
+        "imports": round(sum(imports.values()), 6),
+        "slowest_imports": sorted(imports.items(), key=lambda i: -i[1])[:3],
+    }
+
+
+def benchmark_tree(tree: dict, env: dict) -> list:
+    """
+    Run all selected tools against the generated tree.
+    """
+    results = []
+    count = len(tree["files"])
+    common_args = ["-c", tree["config"]]
+    if "rsync_to_remote" in tools:
+        sync_cmd = ["rsync_to_remote.py", *common_args, "-m", tree["file_map"]]
+        sync_cmd += ["-a", "-rt", "0", "-vt", "0", "-tr", args.transport]
+        sync_cmd += ["-j", args.jobs]
+        results.append(
+            run_tool(
+                "rsync_to_remote",
+                sync_cmd + ["-fo"],
+                env,
+                count,
+                tree["bytes"],
+            )
+        )
+        results.append(
+            run_tool("rsync_to_remote (no-op)", sync_cmd, env, count, 0)
+        )
+    if "create_path_sync" in tools or "file_map" in tools:
+        seed_remote(tree)
+    if "create_path_sync" in tools:
+        target = tree["config"].parent / "synced_file_map.yaml"
+        cps_cmd = ["create_path_sync.py", *common_args, "-t", target]
+        results.append(run_tool("create_path_sync", cps_cmd, env, count, 0))
+    if "file_map" in tools:
+        samples = list(tree["files"].values())[: args.add_samples]
+        durations = []
+        for source, _ in samples:
+            # empty synced file map forces ssh search
+            empty_map = tree["config"].parent / "empty_synced_file_map.yaml"
+            write_yaml(empty_map, {})
+            result = run_tool(
+                "file_map -a",
+                ["file_map.py", *common_args, "-m", tree["file_map"]]
+                + ["-a", source, "-t", "added", "-sm", empty_map],
+                env,
+                1,
+                0,
+            )
+            durations.append(result["duration"])
+        if samples:
+            result |= {
+                "files": len(samples),
+                "duration": round(sum(durations), 6),
+                "latency": round(sum(durations) / len(samples), 6),
+                "p50": round(percentile(durations, 50), 6),
+                "p95": round(percentile(durations, 95), 6),
+                "ssh_calls": result["ssh_calls"] * len(samples),
+            }
+            results.append(result)
+    if "startup" in tools:
+        for name, cmd in [
+            (
+                "startup file_map -v",
+                ["file_map.py", "-m", tree["file_map"], "-v"],
+            ),
+            ("startup rsync_to_remote -h", ["rsync_to_remote.py", "-h"]),
+            ("startup create_path_sync -h", ["create_path_sync.py", "-h"]),
+        ]:
+            results.append(run_startup(name, cmd, env))
+    return results
+
+
+def print_results(count: int, results: list):
+    print(f"{BLD}{f' {count} files '.center(80, '=')}{RST}")
+    print(
+        f"{'run':<26}{'time [s]':>10}{'MB/s':>9}{'p50 [ms]':>10}"
+        f"{'p95 [ms]':>10}{'ssh':>7}{'rsync':>7}"
+    )
+    for result in results:
+        color = GB if result["exit_status"] == 0 else RB
+        p50 = result.get("p50", result["latency"]) * 1000
+        p95 = result.get("p95", result["latency"]) * 1000
+        print(
+            f"{color}{result['run']:<26}{RST}{result['duration']:>10.3f}"
+            f"{result['throughput'] / 1e6:>9.2f}{p50:>10.2f}{p95:>10.2f}"
+            f"{result['ssh_calls']:>7}{result['rsync_calls']:>7}"
+        )
+        if "imports" in result:
+            slowest = ", ".join(
+                f"{module} {duration * 1000:.1f}"
+                for module, duration in result["slowest_imports"]
+            )
+            print(f"    imports {result['imports'] * 1000:.1f} ms: {slowest}")
+    print()
+
+
+def main():
+    global scripts_dir
+    # shim master socket is plain file, don't let it outlive the benchmark
+    shim_socket = SSHConnection(
+        getpass.getuser(), "syncsuite-bench", args.port
+    ).socket
+    with TemporaryDirectory(prefix="syncsuite-bench-") as tmp_dir:
+        work_dir = Path(tmp_dir)
+        if args.work_dir:
+            # only generated subdir is cleaned, never the given dir itself
+            work_dir = Path(args.work_dir).resolve() / "syncsuite-bench"
+            shutil.rmtree(work_dir, ignore_errors=True)
+        env = install_shims(work_dir / "bin")
+        scripts_dir = work_dir / "scripts"
+        install_scripts(scripts_dir)
+        # YAML written here is cached for the copied scripts
+        common.yaml_cache_dir = (
+            scripts_dir / common.yaml_cache_dir.relative_to(script_root)
+        )
+        mode = (
+            "local sshd" if args.real_ssh else f"shim ssh ({args.latency} s)"
+        )
+        print(
+            f"{BLD}Benchmark using {CB}{mode}{RST}{BLD} in {work_dir}{RST}\n"
+        )
+        for count in sizes:
+            print(f"Generating tree of {count} files...")
+            tree = build_tree(
+                work_dir / f"tree_{count}", count, Random(args.seed)
+            )
+            results = benchmark_tree(tree, env)
+            print_results(count, results)
+            if args.output:
+                with open(args.output, "a") as f:
+                    for result in results:
+                        f.write(json.dumps({"tree": count} | result) + "\n")
+        shim_socket.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,18 +12,21 @@ first and if file is not found, then it will try finding it via ssh.
 Result is written in target file if specified, or target dir as
 'synced_file_map.yaml' file or in the script root if target is not specified.
 
-The process is quite lengthy, so try to have a lunch while it is running... ;)
-and repeat it once in a while. (~400 files takes around 6 minutes)
+Remote browse dir is listed once (single find over persistent SSH connection)
+and every local file is resolved against this index, so repeat it once
+in a while.
 """
 
+import json
+import re
+import shlex
 from argparse import RawDescriptionHelpFormatter
 from os import chdir
 from pathlib import Path
-from subprocess import PIPE, STDOUT, run
+from shutil import copyfile
+from subprocess import PIPE, Popen, run
 from time import sleep
 
-from tqdm import tqdm
-
 from common import (
     BLD,
     CB,
@@ -31,15 +34,25 @@ from common import (
     RB,
     RST,
     CustomArgParser,
+    HashCache,
+    MetricsWriter,
+    PhaseTimer,
+    RemoteIndex,
+    compose_ssh_command,
+    get_branch_map_file,
     get_configuration_file,
-    ignored_extensions,
-    ignored_files,
-    ignored_folders,
+    get_local_files,
+    get_remote_states,
+    git_output,
+    is_ignored_path,
+    pick_by_content,
     read_yaml,
     write_yaml,
 )
 
 DRY_RUN = False
+# max number of file names searched for on remote in single find
+MAX_NAME_FILTER = 1000
 
 script_root = Path(__file__).resolve().parent
 config_filename = Path("sync_conf.yaml")
@@ -64,6 +77,25 @@ cap.add_argument(
 )
 cap.add_argument("-c", "--config", help="Configuration file name")
 cap.add_argument("-t", "--target", help="Target file name")
+cap.add_argument(
+    "-g",
+    "--git_files",
+    action="store_true",
+    help="Take local files from 'git ls-files' (respects .gitignore)",
+)
+cap.add_argument(
+    "-re",
+    "--resume",
+    action="store_true",
+    help="Continue interrupted run, skip files already resolved by it",
+)
+cap.add_argument(
+    "-i",
+    "--incremental",
+    action="store_true",
+    help="Refresh existing target, resolve only added/renamed files and "
+    "files, whose remote counterpart disappeared",
+)
 
 args = cap.parse_args()
 
@@ -102,10 +134,65 @@ ssh_usr = sync_conf["rsync"]["username"]
 ssh_port = sync_conf["rsync"]["port"]
 root_dir = sync_conf["rsync"]["local_root_dir"]
 remote_dir = sync_conf["script"]["default_browse_dir"]
+ssh_config = {
+    "host": ssh_host,
+    "username": ssh_usr,
+    "port": ssh_port,
+    "persistent": True,
+    "control_persist": sync_conf["rsync"].get("control_persist", 20),
+}
 
 file_map = {}
+metrics = MetricsWriter("create_path_sync", buffered=True)
 not_found_files = []
-multiple_matches = []
+# local file -> remote candidates with equally long matching path suffix
+multiple_matches = {}
+
+
+class Journal:
+    """
+    Append-only JSON lines record of resolved files, so interrupted run
+    can be resumed. Each line is flushed as soon as it is written.
+    """
+
+    def __init__(self, file: Path):
+        self.file = file
+        self._f = None
+
+    def add(self, local: str, **fields):
+        """
+        Record result of local file: remote path, tied candidates
+        or nothing (not found).
+        """
+        if self._f is None:
+            self._f = open(self.file, "a", buffering=1)
+            # finish line cut by interruption of previous run
+            if self._f.tell() and not self.file.read_bytes().endswith(b"\n"):
+                self._f.write("\n")
+        self._f.write(json.dumps({"local": local} | fields) + "\n")
+
+    def read(self) -> dict:
+        """
+        Return the last record of every local file in journal.
+        """
+        records = {}
+        if not self.file.exists():
+            return records
+        with open(self.file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # line cut by interruption
+                    continue
+                records[record["local"]] = record
+        return records
+
+    def remove(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self.file.unlink(missing_ok=True)
 
 
 def get_git_branch_name() -> str:
@@ -124,24 +211,41 @@ def get_git_branch_name() -> str:
     return res.stdout.strip()
 
 
+# files of current branch, set by set_branch_files()
+branch = ""
+branch_map_file = state_file = journal_file = journal = None
+
+
+def set_branch_files():
+    """
+    Set files of current git branch and remote and create their dir.
+    Git is asked only when file map is really created (not for dry run).
+    """
+    global branch, branch_map_file, state_file, journal_file, journal
+    branch = get_git_branch_name()
+    # synced file map of current branch and remote (target gets its copy)
+    branch_map_file = get_branch_map_file(
+        synced_filemap_file, f"{ssh_usr}@{ssh_host}_{ssh_port}", branch
+    )
+    branch_map_file.parent.mkdir(parents=True, exist_ok=True)
+    # commit, remote and unresolved files of the last run (for -i)
+    state_file = branch_map_file.with_name(
+        f"{branch_map_file.stem}.state.yaml"
+    )
+    # results of current run, appended as files are resolved (for -re)
+    journal_file = branch_map_file.with_name(
+        f"{branch_map_file.stem}.journal.jsonl"
+    )
+    journal = Journal(journal_file)
+
+
 def get_remote_hostname() -> str:
     """
     Get the remote hostname and open persistent SSH connection.
     """
     hostname = (
         run(
-            [
-                "ssh",
-                "-M",
-                "-S",
-                "/tmp/pathsync_socket",
-                "-o",
-                "ControlPersist=20",
-                "-p",
-                str(ssh_port),
-                f"{ssh_usr}@{ssh_host}",
-                "hostname",
-            ],
+            compose_ssh_command(ssh_config, ["hostname"]),
             stdout=PIPE,
         )
         .stdout.decode("utf-8")
@@ -150,22 +254,7 @@ def get_remote_hostname() -> str:
     return hostname
 
 
-def get_top_level_dir(file: str | Path, levels=1) -> str:
-    """
-    Get the n top-level directories of a file path.
-
-    :param file: The file path as a string or Path object.
-    :param levels: Number of top-level directories to return.
-    :return: The top-level directory as a string.
-    """
-
-    if isinstance(file, str):
-        file = Path(file)
-    path = "/".join(file.parts[-(levels + 1) :])
-    return path
-
-
-def print_and_log_results(files: list, not_found: list, multiple: list):
+def print_and_log_results(files: list, not_found: list, multiple: dict):
     print(
         f"\n{BLD}{len(files)} local files found.{RST} \
         {len(files) - len(not_found) - len(multiple)} "
@@ -183,104 +272,390 @@ def print_and_log_results(files: list, not_found: list, multiple: list):
             f"host. See dev log for details."
         )
         I_LOGGER.warning(
-            multiple,
+            [
+                f"{local}: {' | '.join(candidates)}"
+                for local, candidates in multiple.items()
+            ],
             "Multiple matches found for files on remote host:",
         )
 
 
-def filter_results_by_top_level(
-    results: list, local_path: str, levels: int
-) -> list:
-    """
-    Filter results based on top-level directory match.
-
-    :param results: List of file paths from the remote host.
-    :param local_path: Local file path.
-    :param levels: Number of top-level directories to match.
-    :return: Filtered list of results.
-    """
-    local_top_level = get_top_level_dir(local_path, levels)
-    return [
-        path
-        for path in results
-        if local_top_level == get_top_level_dir(path, levels)
-    ]
-
-
-def find_match(file: Path):
-    """
-    Resolve the result of the SSH command to find the best match for the local
-    file. If multiple matches are found, return the longest path match.
-    If no matches are found, return None.
-    """
-    result = run(
-        [
-            "ssh",
-            "-S",
-            "/tmp/pathsync_socket",
-            "-p",
-            str(ssh_port),
-            f"{ssh_usr}@{ssh_host}",
-            "find",
-            remote_dir,
-            "-name",
-            str(file.name),
-            "2>/dev/null",
-        ],
-        stdout=PIPE,
-        stderr=STDOUT,
-        text=True,
-    ).stdout.splitlines()
-
-    if result:
-        local_path = file.as_posix()
-        relative_local_path = file.relative_to(root_dir).as_posix()
-
-        match len(result):
-            case n if n > 1:
-                for levels in range(1, 4):
-                    result = filter_results_by_top_level(
-                        result, local_path, levels
-                    )
-                    if len(result) <= 1:
-                        break
-                match len(result):
-                    case n if n > 1:
-                        multiple_matches.append(relative_local_path)
-                    case 1:
-                        file_map[relative_local_path] = result[0]
-                    case _:
-                        not_found_files.append(relative_local_path)
-            case 1:
-                file_map[relative_local_path] = result[0]
-            case _:
-                not_found_files.append(relative_local_path)
-    else:
-        not_found_files.append(file.relative_to(root_dir).as_posix())
+class SuffixTrie:
+    """
+    Index of paths by their reversed components (file name first), so paths
+    sharing the longest suffix with given path are found in single walk.
+    """
+
+    __slots__ = ("children", "paths")
+
+    def __init__(self):
+        self.children = {}
+        # paths ending in this node (no more parent dirs)
+        self.paths = []
+
+    def add(self, path: str):
+        node = self
+        for part in reversed(path.split("/")):
+            if part:
+                node = node.children.setdefault(part, SuffixTrie())
+        node.paths.append(path)
+
+    def _collect(self) -> list:
+        paths, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            paths += node.paths
+            stack += node.children.values()
+        return paths
+
+    def best_matches(self, path: str) -> list:
+        """
+        Return all indexed paths with the longest common suffix with path
+        (at least the file name). More than one path means a tie.
+        """
+        node = self
+        for part in reversed(path.split("/")):
+            child = node.children.get(part) if part else node
+            if child is None:
+                break
+            node = child
+        return [] if node is self else node._collect()
+
+
+def get_remote_index(names: set | None = None) -> SuffixTrie:
+    """
+    List all files in remote browse dir in single SSH call and index them
+    by file name. Output of find is processed line by line, as it streams.
+
+    :param names: If set, list only files with these names.
+    :return: Suffix trie of remote paths.
+    """
+    timer = PhaseTimer()
+    index = SuffixTrie()
+    count = 0
+    name_filter = []
+    for name in sorted(names or []):
+        # names are matched literally, not as patterns
+        pattern = re.sub(r"([*?\[\\])", r"\\\1", name)
+        name_filter += ["-o", "-name", shlex.quote(pattern)]
+    if name_filter:
+        name_filter = ["\\("] + name_filter[1:] + ["\\)"]
+    with timer.phase("ssh"):
+        with Popen(
+            compose_ssh_command(
+                ssh_config,
+                ["find", remote_dir, "-type", "f", *name_filter]
+                + ["-printf", "'%p\\n'", "2>/dev/null"],
+            ),
+            stdout=PIPE,
+            text=True,
+        ) as process:
+            for line in process.stdout:
+                path = line.rstrip("\n")
+                index.add(path)
+                count += 1
+    metrics.record(
+        "remote_index",
+        timer,
+        files=0,
+        exit_status=process.returncode,
+        remote_files=count,
+    )
+    return index
+
+
+def get_shared_index(
+    remote_index: RemoteIndex, names: set | None = None
+) -> SuffixTrie:
+    """
+    Refresh local index of remote browse dir (shared with 'file_map -a')
+    and build suffix trie of remote files from it.
+
+    :param remote_index: Shared index of remote browse dir.
+    :param names: If set, index only files with these names.
+    :return: Suffix trie of remote paths.
+    """
+    timer = PhaseTimer()
+    index = SuffixTrie()
+    count = 0
+    exit_status = 0
+    with timer.phase("ssh"):
+        try:
+            remote_index.refresh(max_age=0)
+        except OSError as err:
+            # match against the last listing
+            print(f"{RB}{err}{RST}")
+            exit_status = 1
+    with timer.phase("index"):
+        for path in remote_index.paths():
+            if names is None or path.rsplit("/", 1)[-1] in names:
+                index.add(path)
+                count += 1
+    metrics.record(
+        "remote_index",
+        timer,
+        files=0,
+        exit_status=exit_status,
+        remote_files=count,
+    )
+    return index
+
+
+def find_match(file: Path, index: SuffixTrie):
+    """
+    Find remote files sharing the longest path suffix with the local file
+    in remote index. Duration is recorded to metrics (written at the end
+    of run).
+    """
+    timer = PhaseTimer()
+    with timer.phase("match"):
+        resolve_match(file, index.best_matches(file.as_posix()))
+    metrics.record(
+        "find_match", timer, source=file.relative_to(root_dir).as_posix()
+    )
+
+
+def resolve_match(file: Path, result: list):
+    """
+    Store the only best match for the local file. If there is a tie,
+    candidates are kept in multiple_matches, if there is no match,
+    file is added to not_found_files.
+    """
+    relative_local_path = file.relative_to(root_dir).as_posix()
+    match len(result):
+        case 1:
+            file_map[relative_local_path] = result[0]
+            journal.add(relative_local_path, remote=result[0])
+        case 0:
+            not_found_files.append(relative_local_path)
+            journal.add(relative_local_path)
+        case _:
+            multiple_matches[relative_local_path] = sorted(result)
+            journal.add(relative_local_path, candidates=sorted(result))
+
+
+def resolve_by_content():
+    """
+    Pick remote counterparts of files with tied matches by content. All
+    candidates are hashed in single SSH call (hashes are cached).
+    """
+    timer = PhaseTimer()
+    ambiguous = {
+        (Path(root_dir) / local).as_posix(): candidates
+        for local, candidates in multiple_matches.items()
+    }
+    with timer.phase("ssh"):
+        picked = pick_by_content(ssh_config, ambiguous, HashCache())
+    for local in list(multiple_matches):
+        remote = picked.get((Path(root_dir) / local).as_posix())
+        if remote:
+            file_map[local] = remote
+            del multiple_matches[local]
+            journal.add(local, remote=remote)
+    metrics.record(
+        "content_match",
+        timer,
+        files=0,
+        ambiguous=len(ambiguous),
+        picked=len(picked),
+    )
+
+
+def get_git_added(commit: str) -> set | None:
+    """
+    Get local files added since commit (including renamed, uncommitted
+    and untracked ones).
+
+    :param commit: Commit recorded by the last run.
+    :return: Set of added files or None, if git failed.
+    """
+    git = ["-c", "core.quotePath=off"]
+    diff = git_output(
+        root_dir,
+        git + ["diff", "--name-status", "-M", "--relative", commit],
+    )
+    untracked = git_output(
+        root_dir, git + ["ls-files", "--others", "--exclude-standard"]
+    )
+    if diff is None or untracked is None:
+        return None
+    added = set(untracked)
+    for line in diff:
+        status, *paths = line.split("\t")
+        if status[0] in "ACR":
+            added.add(paths[-1])
+    return added
+
+
+def get_local_changes(known: set, state: dict) -> tuple:
+    """
+    Get local files added and removed since the last run. With -g, added
+    files are taken from git diff since recorded commit and removed ones
+    by checking known files, otherwise current tree is compared with files
+    known from the last run.
+
+    :param known: Files mapped or left unresolved by the last run.
+    :param state: State of the last run.
+    :return: Sets of added and removed files (relative to root dir).
+    """
+    added = (
+        get_git_added(state["commit"])
+        if args.git_files and state.get("commit")
+        else None
+    )
+    if added is not None:
+        root = Path(root_dir)
+        added = {
+            file
+            for file in added - known
+            if not is_ignored_path(file) and (root / file).is_file()
+        }
+        return added, {file for file in known if not (root / file).is_file()}
+    current = {
+        file.relative_to(root_dir).as_posix()
+        for file in get_local_files(root_dir, args.git_files)
+    }
+    return current - known, known - current
+
+
+def get_vanished(entries: dict) -> set:
+    """
+    Check all remote counterparts in single SSH call and return local files,
+    whose remote counterpart disappeared.
+    """
+    if not entries:
+        return set()
+    existing = get_remote_states(ssh_config, list(entries.values()))
+    if not existing:
+        print(
+            f"{RB}No remote counterpart found, check the connection "
+            f"or run without -i!{RST}"
+        )
+        exit(1)
+    return {
+        local for local, remote in entries.items() if remote not in existing
+    }
+
+
+def refresh_file_map(previous: dict, state: dict, done: set) -> list:
+    """
+    Take over still valid entries of previous synced file map and return
+    local files, which have to be resolved again.
+
+    :param previous: Previous synced file map.
+    :param state: State of the last run.
+    :param done: Files already resolved by resumed run.
+    :return: List of local files to resolve.
+    """
+    unresolved = set(state.get("unresolved", []))
+    added, removed = get_local_changes(set(previous) | unresolved, state)
+    for local, remote in previous.items():
+        if local not in removed and local not in done:
+            file_map[local] = remote
+            journal.add(local, remote=remote)
+    vanished = get_vanished(file_map)
+    for local in vanished:
+        file_map.pop(local)
+    print(
+        f"{CB}{len(added)}{RST} added, {CB}{len(removed)}{RST} removed "
+        f"local files, {CB}{len(vanished)}{RST} remote counterparts "
+        f"disappeared, {CB}{len(unresolved - removed)}{RST} unresolved "
+        f"before."
+    )
+    to_resolve = (added | vanished | (unresolved - removed)) - (
+        done - vanished
+    )
+    return [Path(root_dir) / file for file in sorted(to_resolve)]
+
+
+def load_journal() -> set:
+    """
+    Fill results from journal and return all files recorded in it.
+    """
+    records = journal.read()
+    file_map.clear()
+    not_found_files.clear()
+    multiple_matches.clear()
+    for local, record in records.items():
+        if "remote" in record:
+            file_map[local] = record["remote"]
+        elif "candidates" in record:
+            multiple_matches[local] = record["candidates"]
+        else:
+            not_found_files.append(local)
+    return set(records)
+
+
+def get_index(files: list) -> SuffixTrie:
+    """
+    Index remote files named as any of files (shared remote index is used,
+    if it exists already).
+    """
+    names = {file.name for file in files}
+    if not names:
+        return SuffixTrie()
+    remote_index = RemoteIndex(ssh_config, remote_dir)
+    # long name filter would not fit remote command line, otherwise
+    # filtered find is cheaper than the first (full) listing of the index
+    if remote_index.dirs or len(names) > MAX_NAME_FILTER:
+        return get_shared_index(remote_index, names)
+    return get_remote_index(names)
+
+
+def seed_branch_map() -> bool:
+    """
+    Seed map of new branch with map (and state) of sibling branch with
+    the closest merge-base, so only the difference has to be resolved.
+
+    :return: True if map was seeded.
+    """
+    closest = None
+    for file in branch_map_file.parent.glob("*.yaml"):
+        if file.name.endswith(".state.yaml"):
+            continue
+        sibling = file.stem.replace("%2F", "/")
+        base = git_output(root_dir, ["merge-base", "HEAD", sibling])
+        distance = base and git_output(
+            root_dir, ["rev-list", "--count", f"{base[0]}..HEAD"]
+        )
+        if distance and (closest is None or int(distance[0]) < closest[0]):
+            closest = (int(distance[0]), file, sibling)
+    if closest is None:
+        return False
+    _, file, sibling = closest
+    print(f"Seeding map of branch {CB}{branch}{RST} from {CB}{sibling}{RST}.")
+    copyfile(file, branch_map_file)
+    sibling_state = file.with_name(f"{file.stem}.state.yaml")
+    if sibling_state.exists():
+        copyfile(sibling_state, state_file)
+    return True
+
+
+def can_refresh(state: dict, host: str) -> bool:
+    """
+    Check if synced file map can be refreshed incrementally.
+    """
+    return (
+        branch_map_file.exists()
+        and state.get("host") == host
+        and state.get("remote_dir") == remote_dir
+    )
 
 
 def main():
-    # get all files in the root directory
-    all_files = [
-        file
-        for file in Path(root_dir).rglob("*")
-        if file.is_file()
-        and not any(folder in file.parts for folder in ignored_folders)
-        and not any(file.suffix == ext for ext in ignored_extensions)
-        and not any(file.name == name for name in ignored_files)
-    ]
     # Enable dry run to set ignored files, folders and extensions in common.py
     if DRY_RUN:
+        all_files = get_local_files(root_dir, args.git_files)
         print(*all_files)
         print(len(all_files))
         exit(0)
 
-    branch = get_git_branch_name()
+    set_branch_files()
     host = get_remote_hostname()
     print(
         f"Syncing file paths from {CB}{root_dir}{RST} \n"
         f"against host {CB}{host}{RST} \n"
-        f"to {CB}{synced_filemap_file.resolve()}{RST} \n"
+        f"to {CB}{branch_map_file.resolve()}{RST} \n"
         f"using branch {CB}{branch}{RST} as reference.\n"
     )
 
@@ -289,6 +664,34 @@ def main():
         print(f"Temporary sync file found: {tmp_filemap_file}. Removing it.")
         tmp_filemap_file.unlink()
 
+    done = set()
+    if args.resume and journal_file.exists():
+        done = load_journal()
+        print(f"Resuming interrupted run, {len(done)} files already done.")
+    elif journal_file.exists():
+        print(
+            f"Journal of interrupted run found: {journal_file}. Removing it."
+        )
+        journal.remove()
+
+    seeded = not branch_map_file.exists() and seed_branch_map()
+    state = read_yaml(state_file) if state_file.exists() else {}
+    if (args.incremental or seeded) and can_refresh(state, host):
+        print("Refreshing synced file map...")
+        previous = read_yaml(branch_map_file)
+        all_files = refresh_file_map(previous, state, done)
+    else:
+        if args.incremental:
+            print(f"{CB}No previous run to refresh, indexing all files.{RST}")
+        all_files = [
+            file
+            for file in get_local_files(root_dir, args.git_files)
+            if file.relative_to(root_dir).as_posix() not in done
+        ]
+    print("Indexing remote files...")
+    index = get_index(all_files)
+    from tqdm import tqdm
+
     with tqdm(
         total=len(all_files),
         desc="Finding matches",
@@ -298,10 +701,24 @@ def main():
     ) as pbar:
         sleep(0.05)
         for file in all_files:
-            find_match(file)
+            find_match(file, index)
             pbar.update(1)
+    if multiple_matches:
+        print(
+            f"Comparing content of {len(multiple_matches)} ambiguous files..."
+        )
+        resolve_by_content()
 
+    # final results are built from journal (including resumed run)
+    all_files = load_journal()
     print_and_log_results(all_files, not_found_files, multiple_matches)
+    if metrics.latencies:
+        summary = metrics.summary()
+        print(
+            f"Per-file latency p50: {CB}{summary['p50']:.3f} s{RST}, "
+            f"p95: {CB}{summary['p95']:.3f} s{RST}"
+        )
+    metrics.flush()
 
     try:
         write_yaml(tmp_filemap_file, file_map)
@@ -311,9 +728,21 @@ def main():
 
     # If the temporary file map was created successfully,
     # move it to the synced file map
-    if synced_filemap_file.exists():
-        synced_filemap_file.unlink()
-    tmp_filemap_file.rename(synced_filemap_file)
+    branch_map_file.unlink(missing_ok=True)
+    tmp_filemap_file.rename(branch_map_file)
+    # current branch map is used by 'file_map -a' also via target
+    copyfile(branch_map_file, synced_filemap_file)
+    commit = git_output(root_dir, ["rev-parse", "HEAD"])
+    write_yaml(
+        state_file,
+        {
+            "commit": commit[0] if commit else None,
+            "host": host,
+            "remote_dir": remote_dir,
+            "unresolved": sorted([*not_found_files, *multiple_matches]),
+        },
+    )
+    journal.remove()
     print(f"\n{BLD}Synced file map saved!{RST}")
 
 
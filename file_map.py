@@ -2,7 +2,7 @@
 
 from argparse import RawDescriptionHelpFormatter
 from pathlib import Path
-from subprocess import PIPE, STDOUT, run
+from subprocess import run
 
 from common import (
     CB,
@@ -10,16 +10,21 @@ from common import (
     RB,
     RST,
     CustomArgParser,
+    FileMap,
+    HashCache,
+    RemoteIndex,
+    RepeatingKeyError,
     config_editor,
     config_filename,
     dir_exists,
     file_exists,
     filemap_filename,
-    get_all_maps,
+    get_branch_map_file,
     get_configuration_file,
+    git_output,
+    pick_by_content,
     read_yaml,
     synced_filemap_filename,
-    write_yaml,
 )
 # import debugpy
 #
@@ -117,30 +122,24 @@ if args.edit:
     run([config_editor, filemap_file])
     exit(0)
 
-file_map = read_yaml(filemap_file)
+try:
+    file_map = FileMap(filemap_file)
+except RepeatingKeyError as err:
+    cap.error(f"{RB}{err}{RST}")
 
 
-def find_next_key(keys: list[int] | set[int]) -> int:
-    """Find next free key for file map dictionary."""
-    keys_set = set(keys)
-    i = 1
-    while i in keys_set:
-        i += 1
-    return i
-
-
-def get_task(file_map: dict, task_name: str | None = None) -> str:
+def get_task(file_map: FileMap, task_name: str | None = None) -> str:
     """
     Check if task name was provided and return it
     or return the last task name in the file map.
     :param task_name: name of the task to check
-    :param file_map: file map dictionary
+    :param file_map: indexed file map
     :return: task name
     """
     if task_name:
         return task_name
-    elif file_map:
-        return list(file_map.keys())[-1]
+    elif file_map.tasks:
+        return file_map.last_task()
     else:
         cap.error(
             f"{RB}No task found in the file map! Provide a task name.{RST}"
@@ -148,16 +147,12 @@ def get_task(file_map: dict, task_name: str | None = None) -> str:
 
 
 def update_file_map(task, src, trg):
-    next_key = find_next_key(list(get_all_maps(file_map).keys()))
-    if task not in list(file_map.keys()):
-        file_map[task] = {next_key: [src, trg]}
-    else:
-        file_map[task][next_key] = [src, trg]
-    write_yaml(filemap_file, file_map)
+    file_map.add(task, src, trg)
+    file_map.save()
 
 
 if args.view:
-    for task, paths in file_map.items():
+    for task, paths in file_map.tasks.items():
         print(f"[{task}]:")
         for num, path in paths.items():
             num_str = f"{num:2}"
@@ -169,17 +164,13 @@ if args.info:
         num = int(args.info)
     except ValueError:
         cap.error(f"Item '{args.info}' is not a valid number!")
-    items = get_all_maps(file_map)
-    if num not in items:
+    if num not in file_map:
         cap.error(f"Item '{num}' not found in file map!")
 
-    task_name = next(
-        (task for task, paths in file_map.items() if num in paths), None
-    )
-
-    print(f"Item '{num}' in task '{task_name}':")
-    print(f"  Source: {items[num][0]}")
-    print(f"  Target: {items[num][1]}")
+    source_file, target_file = file_map.entries[num]
+    print(f"Item '{num}' in task '{file_map.task_of(num)}':")
+    print(f"  Source: {source_file}")
+    print(f"  Target: {target_file}")
     exit(0)
 
 
@@ -215,32 +206,54 @@ def validate_local_files(local_root_dir, source):
 
 
 def find_remote_file(
-    source, ssh_port, username, host, remote_dir
+    source,
+    ssh_port,
+    username,
+    host,
+    remote_dir,
+    control_persist=20,
+    local_root_dir=None,
+    index_ttl=300,
 ) -> str | None:
     """
-    Search for the target file on remote system.
+    Search for the target file in local index of remote system (shared with
+    create_path_sync), which is checked on remote only if it's older than
+    index_ttl or the file is not found in it. If more files are found,
+    the one with the same content (or closest by size and mtime) is picked,
+    if it can't be decided, user is asked.
     """
-    result = run(
-        [
-            "ssh",
-            "-p",
-            str(ssh_port),
-            f"{username}@{host}",
-            "find",
-            remote_dir,
-            "-name",
-            str(source.name),
-            "2>/dev/null",
-        ],
-        stdout=PIPE,
-        stderr=STDOUT,
-        text=True,
-    ).stdout.splitlines()
+    ssh_config = {
+        "host": host,
+        "username": username,
+        "port": ssh_port,
+        "persistent": True,
+        "control_persist": control_persist,
+    }
+    remote_index = RemoteIndex(ssh_config, remote_dir, index_ttl)
+    try:
+        checked = remote_index.refresh()
+        result = remote_index.find(source.name)
+        if not result and not checked:
+            remote_index.refresh(max_age=0)
+            result = remote_index.find(source.name)
+    except OSError as err:
+        print(f"{RB}{err}{RST}")
+        exit(1)
 
     if not result:
         print(f"{RB}File '{source.as_posix()}' not found on remote host!{RST}")
         exit(1)
-    elif len(result) > 1:
+    elif len(result) > 1 and local_root_dir:
+        local_file = (Path(local_root_dir) / source).as_posix()
+        picked = pick_by_content(
+            ssh_config, {local_file: result}, HashCache()
+        ).get(local_file)
+        if picked:
+            print(
+                f"{CB}Multiple files found, picked by content: {picked}{RST}"
+            )
+            return picked
+    if len(result) > 1:
         print(
             f"{CB}Multiple files found with the same name!{RST}"
             f" (Possible candidate(s) highlighted.) \n"
@@ -288,6 +301,14 @@ if args.add:
     synced_file_map = get_configuration_file(
         args.config_dir, args.synced_file_map, synced_filemap_filename
     )
+    # prefer map of current git branch, if it was created
+    branch = git_output(local_root_dir, ["rev-parse", "--abbrev-ref", "HEAD"])
+    if synced_file_map and branch:
+        branch_map = get_branch_map_file(
+            synced_file_map, f"{username}@{host}_{ssh_port}", branch[0]
+        )
+        if branch_map.exists():
+            synced_file_map = branch_map
     target = None
     if synced_file_map:
         synced_files = read_yaml(synced_file_map)
@@ -295,10 +316,17 @@ if args.add:
 
     if not target:
         print(
-            f"{CB}File not found in Synced filemap. Performing ssh search...{RST}"
+            f"{CB}File not found in Synced filemap. Searching remote index...{RST}"
         )
         target = find_remote_file(
-            source, ssh_port, username, host, remote_browse_dir
+            source,
+            ssh_port,
+            username,
+            host,
+            remote_browse_dir,
+            config.get("rsync", {}).get("control_persist", 20),
+            local_root_dir,
+            config.get("script", {}).get("remote_index_ttl", 300),
         )
 
     task_name = get_task(file_map, args.task)
@@ -311,8 +339,8 @@ if args.add:
 if args.delete:
     if isinstance(args.delete, bool):
         if args.task:
-            if args.task in file_map:
-                file_map.pop(args.task)
+            if args.task in file_map.tasks:
+                file_map.remove_task(args.task)
                 print(f"{CB}Deleted task '{args.task}'!{RST}")
             else:
                 cap.error(f"{RB}Task '{args.task}' not found!{RST}")
@@ -323,26 +351,16 @@ if args.delete:
             num = int(args.delete)
         except ValueError:
             cap.error(f"{RB}Invalid item number '{args.delete}'!{RST}")
-        if num not in (get_all_maps(file_map)):
+        if num not in file_map:
             cap.error(f"Item '{num}' not found in file map!")
-        # delete the item from the file map
-        task = ""
-        source_file = ""
-        for tsk, items in file_map.items():
-            if num in items:
-                task = tsk
-                source_file = file_map[tsk][num][0]
-                del file_map[tsk][num]
-                break
-        # if task is empty after adding, delete it too
-        if len(file_map[tsk]) == 0:
-            del file_map[tsk]
+        # task is deleted too, if it's empty afterwards
+        task, (source_file, _) = file_map.remove(num)
 
         print(
             f"{CB}Deleted '[{num}]: {source_file}' from task: '{task}'!{RST}"
         )
 
-    write_yaml(filemap_file, file_map)
+    file_map.save()
     exit(0)
 
 cap.error(f"{CB}Please specify at least one arguments!{RST}")
@@ -0,0 +1,175 @@
+"""
+Helper agent run on remote host by RemoteAgent (see common.py). Its source
+is streamed to remote python3 over ssh stdin, so nothing has to be installed
+there, and it keeps serving requests until the ssh channel is closed.
+
+Every request and response is a frame: header with lengths of JSON part
+and binary payload (two big-endian uint32), JSON part and payload.
+Requests are {"op": name, ...}, responses {"ok": true, "result": ...}
+or {"ok": false, "error": message}.
+
+Only standard library of python3 (3.6+) is used.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+
+HEADER = struct.Struct(">II")
+
+
+def read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    header = read_exactly(stream, HEADER.size)
+    if header is None:
+        return None, b""
+    json_size, payload_size = HEADER.unpack(header)
+    message = read_exactly(stream, json_size)
+    payload = read_exactly(stream, payload_size) if payload_size else b""
+    if message is None or payload is None:
+        return None, b""
+    return json.loads(message.decode()), payload
+
+
+def write_frame(stream, message):
+    data = json.dumps(message).encode()
+    stream.write(HEADER.pack(len(data), 0) + data)
+    stream.flush()
+
+
+def get_state(path, with_hash):
+    stat = os.stat(path)
+    state = {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        state["sha256"] = digest.hexdigest()
+    return state
+
+
+def stat_paths(request, payload):
+    """
+    Stat (and hash) files, missing ones are omitted:
+    {path: {"size": int, "mtime": int[, "sha256": str]}}.
+    """
+    states = {}
+    for path in request["paths"]:
+        try:
+            states[path] = get_state(path, request.get("hash", False))
+        except OSError:
+            continue
+    return states
+
+
+def write_files(request, payload):
+    """
+    Write files from payload (in order of request's files) atomically:
+    to temporary file in target dir, which replaces the target, with
+    mode and mtime of the local file. Files bigger than single frame come
+    in parts (with offset), which are appended to the temporary file
+    until the last one. Result of the last part has size and sha256 of
+    whole received content for verification, or error of the file.
+    """
+    results = {}
+    offset = 0
+    for item in request["files"]:
+        path = item["path"]
+        data = payload[offset : offset + item["size"]]
+        offset += item["size"]
+        part_offset = item.get("offset", 0)
+        tmp_path = os.path.join(
+            os.path.dirname(path) or ".",
+            ".{}.syncsuite-tmp".format(os.path.basename(path)),
+        )
+        try:
+            if part_offset:
+                # missing temporary file means failure of previous part
+                with open(tmp_path, "r+b") as f:
+                    f.seek(part_offset)
+                    f.write(data)
+            else:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+            if not item.get("last", True):
+                continue
+            if part_offset:
+                state = get_state(tmp_path, True)
+            else:
+                state = {
+                    "size": len(data),
+                    "sha256": hashlib.sha256(data).hexdigest(),
+                }
+            os.chmod(tmp_path, item["mode"])
+            os.utime(tmp_path, ns=(item["mtime_ns"], item["mtime_ns"]))
+            os.replace(tmp_path, path)
+        except OSError as err:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            results[path] = {"error": str(err)}
+            continue
+        results[path] = {
+            "size": state["size"],
+            "mtime": item["mtime_ns"] // 1000000000,
+            "sha256": state["sha256"],
+        }
+    return results
+
+
+def restart_services(request, payload):
+    result = subprocess.run(
+        ["systemctl", "restart"] + request["services"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    return {"returncode": result.returncode, "stderr": result.stderr}
+
+
+OPERATIONS = {
+    "hostname": lambda request, payload: socket.gethostname(),
+    "stat": stat_paths,
+    "write": write_files,
+    "restart": restart_services,
+}
+
+
+def main():
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        request, payload = read_frame(stdin)
+        if request is None or request["op"] == "exit":
+            break
+        operation = OPERATIONS.get(request["op"])
+        if operation is None:
+            write_frame(
+                stdout,
+                {"ok": False, "error": "Unknown op " + request["op"]},
+            )
+            continue
+        try:
+            result = operation(request, payload)
+        except Exception as err:
+            write_frame(stdout, {"ok": False, "error": repr(err)})
+            continue
+        write_frame(stdout, {"ok": True, "result": result})
+
+
+if __name__ == "__main__":
+    main()
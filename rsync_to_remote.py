@@ -1,11 +1,23 @@
 #!/usr/bin/env /home/marpauli/.cache/pypoetry/virtualenvs/syncsuite-HX8knUdy-py3.12/bin/python
 
-from argparse import RawDescriptionHelpFormatter
+import asyncio
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import sys
+import tarfile
+from argparse import SUPPRESS, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from io import TextIOBase
 from pathlib import Path
-from subprocess import PIPE, run
-from time import sleep, strftime, time
-
-from pytimedinput import timedKey
+from subprocess import DEVNULL, PIPE, STDOUT, CompletedProcess, Popen, run
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, sleep, strftime, time
 
 from common import (
     BLD,
@@ -18,19 +30,36 @@ from common import (
     WU,
     BadFileSyncDefinition,
     CustomArgParser,
+    FileMap,
+    HashCache,
+    InotifyWatcher,
+    MetricsWriter,
+    PhaseTimer,
+    RemoteAgent,
+    RemoteIndex,
     RepeatingKeyError,
+    RsyncError,
     compose_ssh_command,
     config_editor,
     config_filename,
+    daemon_socket_path,
     filemap_filename,
-    get_all_maps,
     get_configuration_file,
+    get_file_hash,
+    get_file_state,
+    get_remote_states,
+    get_ssh_connection,
+    git_output,
     modify_ssh_options,
+    pick_by_content,
     read_yaml,
+    use_host_log_files,
+    write_yaml,
 )
 
 # define paths
 script_root = Path(__file__).resolve().parent
+manifest_path = script_root / "manifest"
 
 # setup arg parser
 help_message = """
@@ -48,7 +77,11 @@ cap.add_argument(
 )
 cap.add_argument("-c", "--config", help="Path to configuration file")
 cap.add_argument("-m", "--map", help="Path to filemap file")
-cap.add_argument("-r", "--remote", help="Remote host for synchronization")
+cap.add_argument(
+    "-r",
+    "--remote",
+    help="Remote host(s) for synchronization. No spaces, comma as separator.",
+)
 cap.add_argument("-u", "--username", help="Remote username")
 cap.add_argument("-s", "--ssh_port", help="SSH port")
 cap.add_argument(
@@ -86,9 +119,60 @@ cap.add_argument(
     help="Use persistent SSH connection",
     action="store_true",
 )
+cap.add_argument(
+    "-b",
+    "--batch",
+    help="Sync files with same remote dir in single rsync call",
+    action="store_true",
+)
+cap.add_argument(
+    "-j", "--jobs", help="Number of parallel rsync transfers", type=int
+)
+cap.add_argument(
+    "-rs",
+    "--remote_snapshot",
+    help="Stat all remote files at once and sync only the differing ones",
+    action="store_true",
+)
+cap.add_argument(
+    "-ch",
+    "--changed",
+    help="Sync only files changed in git since their last sync",
+    action="store_true",
+)
+cap.add_argument(
+    "-fo",
+    "--force",
+    help="Sync files even if they didn't change since last sync",
+    action="store_true",
+)
+cap.add_argument(
+    "-tr",
+    "--transport",
+    choices=["auto", "rsync", "tar", "agent"],
+    help="Transfer files by rsync, in single tar stream over ssh or by "
+    "remote agent (single ssh channel for the whole session)",
+)
+cap.add_argument(
+    "-w",
+    "--watch",
+    help="Keep running and sync selected files whenever they change",
+    action="store_true",
+)
+cap.add_argument(
+    "-D",
+    "--daemon",
+    help="Keep running and serve requests of syncsuite.py client",
+    action="store_true",
+)
+cap.add_argument(
+    "-so", "--socket", help="Path to Unix socket of the daemon (with -D)"
+)
 cap.add_argument(
     "-e", "--edit", help="Edit configuration file", action="store_true"
 )
+# used internally, when syncing to multiple hosts
+cap.add_argument("--fanout_summary", help=SUPPRESS)
 
 args = cap.parse_args()
 
@@ -114,7 +198,7 @@ if not config_file:
         [
             args.remote,
             args.username,
-            any([args.files, args.task, args.sync_all]),
+            any([args.files, args.task, args.sync_all, args.daemon]),
         ]
     ):
         cap.error(f"{RB}Insufficient arguments provided!{RST}")
@@ -126,8 +210,21 @@ port = 22
 rsync_options = ["-rtvz", "--progress", "-e", "ssh -p 22"]
 date_format = "%Y-%m-%d %H:%M:%S"
 VM_check_timeout = result_timeout = 0
-sync_all = restart_services = persistent_ssh = False
+jobs = 1
+sync_all = restart_services = persistent_ssh = batch_rsync = False
+use_manifest = True
+manifest_hash = force = changed_only = False
+remote_snapshot = snapshot_hash = watch = daemon = False
+watch_debounce = 0.2
+default_browse_dir = "/"
+remote_index_ttl = 300
+transport = "auto"
+tar_compression = "gzip"
+tar_min_files = 20
+tar_max_avg_size = 262144
 host = username = task = file_keys = services = ""
+hosts = []
+control_persist = 20
 
 if config_file:
     # import configuration variables and remove GUI variables
@@ -138,9 +235,11 @@ if config_file:
         globals().update(vals)
 
 # store content of file_map.yaml
-file_map = read_yaml(filemap_file)
 try:
-    all_maps = get_all_maps(file_map)
+    file_map = FileMap(filemap_file)
+    all_maps = file_map.entries
+    # daemon reloads file map, when it changes
+    file_map_stamp = get_file_state(filemap_file)
 except RepeatingKeyError as err:
     print(f"{RB}{err}{RST}")
     LOGGER.info(f"!!! {err} !!!")
@@ -148,7 +247,12 @@ except RepeatingKeyError as err:
 
 # override settings, if set from cli
 if args.remote:
-    host = args.remote
+    hosts = args.remote.split(",")
+if hosts:
+    host = hosts[0]
+    # fan-out child for single host writes to its own log files
+    if args.fanout_summary:
+        use_host_log_files(host)
 if args.username:
     username = args.username
 if args.ssh_port:
@@ -167,7 +271,7 @@ if args.sync_all:
     sync_all = True
 if args.task:
     task = args.task
-    if task not in file_map.keys():
+    if task not in file_map.tasks:
         cap.error(f"{RB}Task '{task}' not found in file map!{RST}")
         cap.exit(1)
 if args.files:
@@ -185,87 +289,885 @@ if args.services_names:
     services = args.services_names.split(",")
 if args.persistent_ssh:
     persistent_ssh = args.persistent_ssh
+if args.batch:
+    batch_rsync = args.batch
+if args.jobs:
+    jobs = args.jobs
+if args.force:
+    force = args.force
+if args.changed:
+    changed_only = args.changed
+    if not use_manifest:
+        cap.error(f"{RB}--changed requires use_manifest to be set!{RST}")
+if args.remote_snapshot:
+    remote_snapshot = args.remote_snapshot
+if args.transport:
+    transport = args.transport
+if args.watch:
+    watch = args.watch
+    # keep single ssh master open for the whole watch session
+    persistent_ssh = True
+    if len(hosts) > 1:
+        cap.error(f"{RB}Watch mode supports single remote host only!{RST}")
+if args.daemon:
+    daemon = args.daemon
+    # keep single ssh master open for the whole daemon session
+    persistent_ssh = True
+    if watch:
+        cap.error(f"{RB}Daemon can't be combined with watch mode!{RST}")
+    if len(hosts) > 1:
+        cap.error(f"{RB}Daemon supports single remote host only!{RST}")
 
 ssh_config = {
     "host": host,
     "username": username,
     "port": port,
     "persistent": persistent_ssh,
+    "control_persist": control_persist,
+}
+
+metrics = MetricsWriter("rsync_to_remote")
+
+# file pairs in sync with remote after this run
+synced_files = []
+# file pairs transferred (or failed to transfer) during this run
+transferred_files = []
+failed_files = []
+# remote agent of the session (with agent transport)
+agent = None
+# state kept by daemon between requests
+remote_index = None
+hash_cache = HashCache()
+served_requests = 0
+# fields of daemon requests and their types (optional fields may be null)
+REQUEST_FIELDS = {
+    "sync": {
+        "files": list,
+        "keys": list,
+        "task": str,
+        "all": bool,
+        "force": bool,
+    },
+    "add": {"source": str, "task": str, "target": str},
+    "view": {},
+    "status": {},
+    "stop": {},
 }
+REQUIRED_FIELDS = {"add": {"source"}}
+# types of items of list fields
+LIST_ITEMS = {"files": str, "keys": int}
 
 
-def get_task_maps(filemap: dict, task_name: str) -> dict:
-    return filemap[task_name]
+def get_task_maps(filemap: FileMap, task_name: str) -> dict:
+    return filemap.tasks[task_name]
 
 
-def run_rsync(filepaths: list, counter: int, persistent: bool = False) -> int:
+def _print_header(filepaths: list, counter: int, tool: str = "rsync") -> str:
+    """
+    Print info about synced file pair and return header of its log entry.
+
+    :param filepaths: [source, target] pair from file map.
+    :param counter: Number of the synced file.
+    :param tool: Name of the tool used for transfer.
+    :return: Log entry header.
+    """
     print(f"{GN}[{counter}]{RST}")
     print(f"{CB}local file: {RST}{WU}{filepaths[0]}{RST}")
     print(f"{CB}remote file: {RST}{WU}{filepaths[1]}{RST}")
-    to_log = (
+    return (
         f"\n*_* [{counter}] *_*\n"
         f"source: {filepaths[0]}\n"
         f"target: {filepaths[1]}\n"
-        f"rsync output:"
+        f"{tool} output:"
     )
+
+
+def _report_result(
+    filepaths: list, to_log: str, stdout: str, stderr: str, counter: int
+) -> int:
+    """
+    Print and log result of a single file transfer.
+
+    :param filepaths: [source, target] pair from file map.
+    :param to_log: Log entry header.
+    :param stdout: rsync output belonging to the file.
+    :param stderr: rsync errors belonging to the file.
+    :param counter: Number of the synced file.
+    :return: Incremented counter, if transfer was successful.
+    """
+    to_log = "\n".join([to_log, stdout])
+    LOGGER.info(to_log)
+    counter += 1
+    if stderr:
+        print(f"{RB}{stderr}{RST}")
+        LOGGER.info(f"\n!!! {stderr} !!!")
+        counter -= 1
+        failed_files.append(filepaths)
+    else:
+        synced_files.append(filepaths)
+        transferred_files.append(filepaths)
+    return counter
+
+
+def _get_rsync_options(persistent: bool) -> list:
     options = rsync_options[:]
-    sync_suite_socket = Path("/tmp/syncsuite_socket")
     # persistent SSH connection should be open,
     # but check it and fall back to non-persistent, if not
-    if persistent and sync_suite_socket.exists():
-        options = modify_ssh_options(
-            options, f"-S {str(sync_suite_socket)} -p {port}"
-        )
+    if persistent:
+        connection = get_ssh_connection(ssh_config)
+        if connection.open():
+            options = modify_ssh_options(
+                options, " ".join(connection.ssh_options())
+            )
+    return options
+
+
+async def run_async(
+    cmd: list, stdin: str | None = None, timer: PhaseTimer | None = None
+) -> CompletedProcess:
+    """
+    Run command in subprocess without blocking the event loop.
+    Process is killed, if the awaiting task is cancelled.
+
+    :param cmd: Command to run.
+    :param stdin: Optional text passed to process stdin.
+    :param timer: If set, time until first output is added as 'handshake'
+                  phase and the rest as 'transfer' phase.
+    :return: Finished process with decoded stdout and stderr.
+    """
+    start = perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=DEVNULL if stdin is None else PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+    )
+    first_output = None
+
+    async def feed_stdin():
+        if stdin is None:
+            return
+        try:
+            proc.stdin.write(stdin.encode())
+            await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def read_stdout() -> bytes:
+        nonlocal first_output
+        chunks = []
+        while chunk := await proc.stdout.read(65536):
+            if first_output is None:
+                first_output = perf_counter()
+            chunks.append(chunk)
+        return b"".join(chunks)
+
     try:
-        result = run(
-            ["rsync"]
-            + options
-            + [
-                (Path(local_root_dir) / filepaths[0]).as_posix(),
-                f"{username}@{host}:{filepaths[1]}",
-            ],
-            stdout=PIPE,
-            stderr=PIPE,
-            text=True,
+        _, stdout, stderr, _ = await asyncio.gather(
+            feed_stdin(), read_stdout(), proc.stderr.read(), proc.wait()
         )
-    except Exception as err:
-        print(f"{RB}Something went wrong! {err}{RST}")
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if timer:
+        end = perf_counter()
+        timer.add("handshake", (first_output or end) - start)
+        timer.add("transfer", end - (first_output or end))
+    return CompletedProcess(
+        cmd,
+        proc.returncode,
+        stdout.decode("utf-8", "replace"),
+        stderr.decode("utf-8", "replace"),
+    )
+
+
+async def _exec_rsync(
+    cmd: list, stdin: str | None = None, timer: PhaseTimer | None = None
+) -> CompletedProcess:
+    try:
+        return await run_async(cmd, stdin, timer)
+    except OSError as err:
         LOGGER.error(f"Error during rsync: {err}")
-        exit(1)
-    else:
-        to_log = "\n".join([to_log, result.stdout])
-        LOGGER.info(to_log)
-        counter += 1
-        if result.stderr:
-            print(f"{RB}{result.stderr}{RST}")
-            LOGGER.info(f"\n!!! {result.stderr} !!!")
-            counter -= 1
+        # reported by caller, daemon must keep running
+        raise RsyncError(f"Something went wrong! {err}") from err
+
+
+async def rsync_file(
+    filepaths: list, persistent: bool = False, timer: PhaseTimer | None = None
+) -> CompletedProcess:
+    """
+    Transfer single file pair and return finished rsync process.
+    """
+    return await _exec_rsync(
+        ["rsync"]
+        + _get_rsync_options(persistent)
+        + [
+            (Path(local_root_dir) / filepaths[0]).as_posix(),
+            f"{username}@{host}:{filepaths[1]}",
+        ],
+        timer=timer,
+    )
+
+
+async def run_rsync(
+    filepaths: list, counter: int, persistent: bool = False
+) -> int:
+    timer = PhaseTimer()
+    to_log = _print_header(filepaths, counter)
+    result = await rsync_file(filepaths, persistent, timer)
+    with timer.phase("logging"):
+        counter = _report_result(
+            filepaths, to_log, result.stdout, result.stderr, counter
+        )
+    record_unit([filepaths], result, timer)
+    return counter
+
+
+def record_unit(pairs: list, result: CompletedProcess, timer: PhaseTimer):
+    """
+    Write metrics of single rsync call (bytes parsed from rsync stats).
+    """
+    sent = re.search(r"sent ([\d,]+) bytes", result.stdout)
+    metrics.record(
+        "rsync",
+        timer,
+        files=len(pairs),
+        bytes=int(sent[1].replace(",", "")) if sent else 0,
+        exit_status=result.returncode,
+        target=pairs[0][1]
+        if len(pairs) == 1
+        else str(Path(pairs[0][1]).parent),
+    )
+
+
+def group_by_remote_dir(maps: list) -> tuple[dict, list]:
+    """
+    Group file pairs by remote target directory.
+    Pairs, which can't be sent in batch (renamed on remote or with duplicate
+    file name in the same remote dir), are returned separately.
+
+    :param maps: List of [source, target] pairs.
+    :return: {remote_dir: [pairs]} and list of pairs to sync one by one.
+    """
+    groups = {}
+    singles = []
+    for paths in maps:
+        source, target = Path(paths[0]), Path(paths[1])
+        group = groups.setdefault(target.parent.as_posix(), [])
+        if source.name != target.name or any(
+            Path(grouped[1]).name == target.name for grouped in group
+        ):
+            singles.append(paths)
+        else:
+            group.append(paths)
+    return {rdir: pairs for rdir, pairs in groups.items() if pairs}, singles
+
+
+def split_rsync_output(output: str, names: list) -> tuple[dict, str]:
+    """
+    Split combined rsync output to parts belonging to single files.
+
+    :param output: stdout or stderr of rsync.
+    :param names: File names sent in the rsync call.
+    :return: {file name: output} and lines not belonging to any file.
+    """
+    per_file = {name: [] for name in names}
+    common_lines = []
+    current = None
+    for line in output.splitlines():
+        stripped = line.strip()
+        if stripped in per_file:
+            current = stripped
+        elif not line.startswith((" ", "\r")):
+            # progress lines are indented, anything else ends file section
+            current = next(
+                (name for name in names if f"/{name}" in line), None
+            )
+            if current is None:
+                common_lines.append(line)
+                continue
+        if current is None:
+            common_lines.append(line)
+        else:
+            per_file[current].append(line)
+    return (
+        {name: "\n".join(lines) for name, lines in per_file.items()},
+        "\n".join(common_lines),
+    )
+
+
+async def rsync_batch(
+    remote_dir: str,
+    maps: list,
+    persistent: bool = False,
+    timer: PhaseTimer | None = None,
+) -> CompletedProcess:
+    """
+    Transfer all file pairs with the same remote dir in single rsync call.
+    File list is passed to rsync via stdin.
+
+    :param remote_dir: Common remote directory of the file pairs.
+    :param maps: List of [source, target] pairs.
+    :param persistent: Whether to use persistent SSH connection.
+    :param timer: Optional timer of the transfer phases.
+    :return: Finished rsync process.
+    """
+    return await _exec_rsync(
+        ["rsync"]
+        + _get_rsync_options(persistent)
+        + [
+            "--files-from=-",
+            "--no-relative",
+            Path(local_root_dir).as_posix() + "/",
+            f"{username}@{host}:{remote_dir}/",
+        ],
+        "\n".join(paths[0] for paths in maps) + "\n",
+        timer,
+    )
+
+
+def report_batch(maps: list, result: CompletedProcess, counter: int) -> int:
+    """
+    Parse output of batched rsync call back to per-file results
+    and print and log them.
+
+    :param maps: List of [source, target] pairs sent in the batch.
+    :param result: Finished rsync process.
+    :param counter: Number of the first synced file.
+    :return: Counter incremented by number of synced files.
+    """
+    names = [Path(paths[1]).name for paths in maps]
+    stdout, stdout_rest = split_rsync_output(result.stdout, names)
+    stderr, stderr_rest = split_rsync_output(result.stderr, names)
+    # error not attributable to any file (e.g. connection refused)
+    # means nothing was transferred
+    failed_all = result.returncode != 0 and not any(stderr.values())
+    for paths, name in zip(maps, names):
+        to_log = _print_header(paths, counter)
+        err = stderr[name] or (stderr_rest if failed_all else "")
+        counter = _report_result(paths, to_log, stdout[name], err, counter)
+    LOGGER.info(stdout_rest)
+    if stderr_rest and not failed_all:
+        print(f"{RB}{stderr_rest}{RST}")
+        LOGGER.info(f"\n!!! {stderr_rest} !!!")
+    return counter
+
+
+def get_sync_units(maps: list) -> list:
+    """
+    Split file pairs to units transferred by single rsync call.
+
+    :param maps: List of [source, target] pairs.
+    :return: List of (remote_dir, pairs) tuples, remote_dir is None
+             for pairs synced one by one.
+    """
+    if not batch_rsync:
+        return [(None, [paths]) for paths in maps]
+    groups, singles = group_by_remote_dir(maps)
+    units = []
+    for remote_dir, pairs in groups.items():
+        if len(pairs) == 1:
+            singles.append(pairs[0])
+        else:
+            units.append((remote_dir, pairs))
+    return units + [(None, [paths]) for paths in singles]
+
+
+async def transfer_unit(
+    remote_dir: str | None,
+    pairs: list,
+    limit: asyncio.Semaphore,
+    timer: PhaseTimer,
+) -> CompletedProcess:
+    async with limit:
+        # queueing for free slot is not part of the transfer
+        timer.start = perf_counter()
+        if remote_dir is None:
+            return await rsync_file(pairs[0], persistent_ssh, timer)
+        return await rsync_batch(remote_dir, pairs, persistent_ssh, timer)
+
+
+def report_unit(
+    remote_dir: str | None,
+    pairs: list,
+    result: CompletedProcess,
+    counter: int,
+) -> int:
+    if remote_dir is None:
+        to_log = _print_header(pairs[0], counter)
+        return _report_result(
+            pairs[0], to_log, result.stdout, result.stderr, counter
+        )
+    return report_batch(pairs, result, counter)
+
+
+def choose_transport(maps: list) -> str:
+    """
+    Decide whether to use rsync or tar stream for the file pairs.
+    Tar is used in auto mode for many (tar_min_files) small (average size
+    up to tar_max_avg_size bytes) files, where per-file rsync protocol
+    work is more expensive than sending the whole content.
+    """
+    if transport != "auto":
+        return transport
+    if len(maps) < tar_min_files:
+        return "rsync"
+    sizes = [
+        get_file_state(Path(local_root_dir) / paths[0]).get("size", 0)
+        for paths in maps
+    ]
+    return "tar" if sum(sizes) / len(sizes) <= tar_max_avg_size else "rsync"
+
+
+def _get_tar_command() -> list:
+    extract = "tar -xvf - --no-same-owner -C /"
+    match tar_compression:
+        case "gzip":
+            extract = "gzip -dc | " + extract
+        case "zstd":
+            extract = "zstd -dcq | " + extract
+    return _get_rsync_ssh_command(["sh", "-c", shlex.quote(extract)])
+
+
+def _get_rsync_ssh_command(remote_cmd: list) -> list:
+    """
+    Compose ssh command connecting the same way as rsync does: with ssh
+    command from its -e (--rsh) option (switched to persistent connection,
+    if used), so custom port or options apply to other transports too.
+
+    :param remote_cmd: Command to run on the remote host.
+    :return: Composed ssh command.
+    """
+    options = _get_rsync_options(persistent_ssh)
+    for n, option in enumerate(options):
+        if option in ("-e", "--rsh") and n + 1 < len(options):
+            rsh = options[n + 1]
+        elif option.startswith("--rsh="):
+            rsh = option.removeprefix("--rsh=")
+        else:
+            continue
+        return shlex.split(rsh) + [f"{username}@{host}"] + remote_cmd
+    return compose_ssh_command(ssh_config, remote_cmd)
+
+
+def _read_stream(stream, lines: list):
+    lines.extend(stream.read().decode("utf-8", "replace").splitlines())
+
+
+def tar_files(maps: list) -> tuple[list, list, int]:
+    """
+    Stream all file pairs in single tar archive through ssh and unpack
+    every file to its remote path. Remote tar lists extracted files,
+    which is used to report per-file results.
+
+    :param maps: List of [source, target] pairs.
+    :return: stdout lines, stderr lines and return code of remote tar.
+    """
+    ssh = Popen(_get_tar_command(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = [], []
+    readers = [
+        Thread(target=_read_stream, args=(ssh.stdout, stdout)),
+        Thread(target=_read_stream, args=(ssh.stderr, stderr)),
+    ]
+    for reader in readers:
+        reader.start()
+    compressor = None
+    stream = ssh.stdin
+    if tar_compression == "zstd":
+        compressor = Popen(["zstd", "-qc"], stdin=PIPE, stdout=ssh.stdin)
+        stream = compressor.stdin
+    mode = "w|gz" if tar_compression == "gzip" else "w|"
+    added = set()
+    try:
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            for source, target in maps:
+                arcname = target.lstrip("/")
+                if arcname in added:
+                    continue
+                local_file = Path(local_root_dir) / source
+                if not local_file.is_file():
+                    stderr.append(f"{arcname}: local file not found")
+                    continue
+                tar.add(local_file, arcname=arcname, recursive=False)
+                added.add(arcname)
+    except (BrokenPipeError, OSError) as err:
+        stderr.append(f"Tar stream interrupted: {err}")
+    finally:
+        stream.close()
+        if compressor:
+            compressor.wait()
+            ssh.stdin.close()
+    for reader in readers:
+        reader.join()
+    return stdout, stderr, ssh.wait()
+
+
+def run_tar(maps: list, counter: int) -> int:
+    """
+    Sync file pairs using tar stream and report results per file.
+
+    :param maps: List of [source, target] pairs.
+    :param counter: Number of the first synced file.
+    :return: Counter incremented by number of synced files.
+    """
+    timer = PhaseTimer()
+    with timer.phase("transfer"):
+        stdout, stderr, returncode = tar_files(maps)
+    with timer.phase("logging"):
+        counter = report_tar(maps, stdout, stderr, returncode, counter)
+    metrics.record(
+        "tar",
+        timer,
+        files=len(maps),
+        bytes=sum(
+            get_file_state(Path(local_root_dir) / paths[0]).get("size", 0)
+            for paths in maps
+        ),
+        exit_status=returncode,
+    )
+    return counter
+
+
+def report_tar(
+    maps: list, stdout: list, stderr: list, returncode: int, counter: int
+) -> int:
+    """
+    Print and log result of every file pair sent in tar stream.
+    """
+    extracted = set(stdout)
+    common_errors = [
+        line
+        for line in stderr
+        if not any(paths[1].lstrip("/") in line for paths in maps)
+    ]
+    for paths in maps:
+        arcname = paths[1].lstrip("/")
+        to_log = _print_header(paths, counter, "tar")
+        errors = [line for line in stderr if arcname in line]
+        if arcname not in extracted and not errors:
+            errors = common_errors or [f"{arcname}: not extracted on remote"]
+        output = arcname if arcname in extracted else ""
+        counter = _report_result(
+            paths, to_log, output, "\n".join(errors), counter
+        )
+    if common_errors and returncode == 0:
+        LOGGER.info("\n".join(common_errors))
+    return counter
+
+
+async def sync_maps_async(maps: list, counter: int = 1) -> int:
+    """
+    Sync list of file pairs. With jobs > 1, up to jobs transfers run
+    at once (sharing persistent SSH connection, if used), but results
+    are still printed and logged in order, as soon as they land.
+
+    :param maps: List of [source, target] pairs.
+    :param counter: Number of the first synced file.
+    :return: Counter incremented by number of synced files.
+    """
+    if maps and choose_transport(maps) == "tar":
+        return await asyncio.to_thread(run_tar, maps, counter)
+    if maps and transport == "agent":
+        return await asyncio.to_thread(run_agent, maps, counter)
+    units = get_sync_units(maps)
+    if jobs <= 1:
+        for remote_dir, pairs in units:
+            if remote_dir is None:
+                counter = await run_rsync(pairs[0], counter, persistent_ssh)
+                continue
+            timer = PhaseTimer()
+            result = await rsync_batch(
+                remote_dir, pairs, persistent_ssh, timer
+            )
+            with timer.phase("logging"):
+                counter = report_unit(remote_dir, pairs, result, counter)
+            record_unit(pairs, result, timer)
         return counter
+    limit = asyncio.Semaphore(jobs)
+    timers = [PhaseTimer() for _ in units]
+    transfers = [
+        asyncio.create_task(transfer_unit(*unit, limit, timer))
+        for unit, timer in zip(units, timers)
+    ]
+    for (remote_dir, pairs), transfer, timer in zip(units, transfers, timers):
+        result = await transfer
+        with timer.phase("logging"):
+            counter = report_unit(remote_dir, pairs, result, counter)
+        record_unit(pairs, result, timer)
+    return counter
 
 
-def synchronize_files(all_maps) -> int:
+def get_agent() -> RemoteAgent:
+    """
+    Return remote agent of this session, (re)started if it's not running.
+    """
+    global agent
+    if agent is None:
+        agent = RemoteAgent(ssh_config)
+    agent.start()
+    return agent
+
+
+def run_agent(maps: list, counter: int) -> int:
+    """
+    Sync file pairs by remote agent (files are written atomically and
+    verified by sha256) and report results per file.
+
+    :param maps: List of [source, target] pairs.
+    :param counter: Number of the first synced file.
+    :return: Counter incremented by number of synced files.
+    """
+    timer = PhaseTimer()
+    with timer.phase("transfer"):
+        try:
+            results = get_agent().write_files(
+                [
+                    (Path(local_root_dir) / source, target)
+                    for source, target in maps
+                ]
+            )
+        except OSError as err:
+            results = {target: {"error": str(err)} for _, target in maps}
+    with timer.phase("logging"):
+        for paths in maps:
+            to_log = _print_header(paths, counter, "agent")
+            result = results.get(paths[1], {})
+            error = result.get("error", "")
+            if not result:
+                error = f"{paths[1]}: not written on remote"
+            output = "" if error else f"{paths[1]} ({result['size']} B)"
+            counter = _report_result(paths, to_log, output, error, counter)
+    metrics.record(
+        "agent",
+        timer,
+        files=len(maps),
+        bytes=sum(result.get("size", 0) for result in results.values()),
+        exit_status=int(any("error" in r for r in results.values())),
+    )
+    return counter
+
+
+def sync_maps(maps: list, counter: int = 1) -> int:
+    """
+    Blocking variant of sync_maps_async (used outside of event loop).
+    """
+    return asyncio.run(sync_maps_async(maps, counter))
+
+
+def get_selected_maps(all_maps: dict) -> dict:
     # decide what to sync based on settings
     if sync_all:
-        i = 1
-        for paths in all_maps.values():
-            i = run_rsync(paths, i, persistent_ssh)
-        return i
+        return dict(all_maps)
     elif task:
-        file_maps = get_task_maps(file_map, task)
-        i = 1
-        for paths in file_maps.values():
-            i = run_rsync(paths, i, persistent_ssh)
-        return i
+        return dict(get_task_maps(file_map, task))
     elif len(file_keys) > 0:
-        i = 1
-        for k in file_keys:
-            i = run_rsync(all_maps[k], i, persistent_ssh)
-        return i
+        return {k: all_maps[k] for k in file_keys}
     else:
         raise BadFileSyncDefinition
 
 
-def _restart_services():
+def filter_remote_unchanged(selected_maps: dict) -> dict:
+    """
+    Compare local files with remote snapshot fetched in single SSH call
+    and remove pairs, which are already identical on remote.
+    Same size and mtime (or sha256, if snapshot_hash is set) is considered
+    identical, just like rsync's quick check.
+
+    :param selected_maps: {file key: [source, target]}
+    :return: {file key: [source, target]} of differing files.
+    """
+    print("Fetching remote snapshot...")
+    remote_paths = list({paths[1] for paths in selected_maps.values()})
+    if transport == "agent":
+        remote_states = get_agent().stat(remote_paths, snapshot_hash)
+    else:
+        remote_states = get_remote_states(
+            ssh_config, remote_paths, snapshot_hash
+        )
+    changed_maps = {}
+    for key, paths in selected_maps.items():
+        source = Path(local_root_dir) / paths[0]
+        local = get_file_state(source)
+        remote = remote_states.get(paths[1], {})
+        if not local or local["size"] != remote.get("size"):
+            changed_maps[key] = paths
+        elif snapshot_hash and "sha256" in remote:
+            if get_file_hash(source) != remote["sha256"]:
+                changed_maps[key] = paths
+        elif local["mtime_ns"] // 1_000_000_000 != remote.get("mtime"):
+            changed_maps[key] = paths
+        if key not in changed_maps:
+            synced_files.append(paths)
+    identical = len(selected_maps) - len(changed_maps)
+    if identical:
+        print(f"{CB}{identical} file(s) already up to date on remote.{RST}")
+        LOGGER.info(f"Up to date on remote file(s) count: {identical}")
+    return changed_maps
+
+
+async def synchronize_files(selected_maps: dict) -> int:
+    if remote_snapshot:
+        selected_maps = await asyncio.to_thread(
+            filter_remote_unchanged, selected_maps
+        )
+    return await sync_maps_async(list(selected_maps.values()))
+
+
+def get_manifest_file() -> Path:
+    return manifest_path / f"{username}@{host}_{port}.yaml"
+
+
+def read_manifest() -> dict:
+    """
+    Read manifest of files synced to current remote.
+    Manifest written for another remote (or port) is ignored.
+
+    :return: {file key: {source, target, size, mtime_ns[, sha256]}}
+    """
+    manifest_file = get_manifest_file()
+    if not manifest_file.exists():
+        return {}
+    manifest = read_yaml(manifest_file) or {}
+    if manifest.get("remote") != f"{username}@{host}:{port}":
+        return {}
+    return manifest.get("files") or {}
+
+
+def get_local_states(selected_maps: dict) -> dict:
+    """
+    Get state of local source files of selected file pairs.
+
+    :param selected_maps: {file key: [source, target]}
+    :return: {file key: {source, target, size, mtime_ns[, commit]}}
+    """
+    # git commit of local root dir, used as sync point for --changed
+    head = git_output(local_root_dir, ["rev-parse", "HEAD"])
+    states = {}
+    for key, paths in selected_maps.items():
+        source = (Path(local_root_dir) / paths[0]).as_posix()
+        states[key] = {
+            "source": source,
+            "target": paths[1],
+        } | get_file_state(source)
+        if head:
+            states[key]["commit"] = head[0]
+    return states
+
+
+def get_git_changed_files(commit: str) -> set | None:
+    """
+    Return paths (relative to local root dir) of files changed since commit,
+    including uncommitted and untracked files.
+
+    :param commit: Commit recorded at the last sync.
+    :return: Set of paths or None, if commit is unknown to git.
+    """
+    git = ["-c", "core.quotePath=off"]
+    changed = git_output(
+        local_root_dir, git + ["diff", "--name-only", "--relative", commit]
+    )
+    if changed is None:
+        return None
+    untracked = git_output(
+        local_root_dir, git + ["ls-files", "--others", "--exclude-standard"]
+    )
+    return set(changed) | set(untracked or [])
+
+
+def filter_git_changed(selected_maps: dict, manifest: dict) -> dict:
+    """
+    Keep only file pairs, whose source changed in git since the commit
+    recorded at their last sync. Pairs never synced are always kept.
+
+    :param selected_maps: {file key: [source, target]}
+    :param manifest: Manifest of current remote.
+    :return: {file key: [source, target]} of changed files.
+    """
+    # reverse index: source path -> file keys, grouped by sync point
+    by_commit = {}
+    changed_keys = set()
+    for key, paths in selected_maps.items():
+        commit = manifest.get(key, {}).get("commit")
+        if not commit:
+            changed_keys.add(key)
+            continue
+        source = Path(paths[0]).as_posix()
+        by_commit.setdefault(commit, {}).setdefault(source, []).append(key)
+    for commit, index in by_commit.items():
+        changed_files = get_git_changed_files(commit)
+        if changed_files is None:
+            # sync point not reachable (e.g. after rebase), sync everything
+            changed_keys.update(k for keys in index.values() for k in keys)
+            continue
+        for changed_file in changed_files:
+            changed_keys.update(index.get(changed_file, []))
+    return {
+        key: paths
+        for key, paths in selected_maps.items()
+        if key in changed_keys
+    }
+
+
+def is_unchanged(state: dict, recorded: dict | None) -> bool:
+    """
+    Compare current state of local file with state recorded in manifest.
+    If only mtime differs and manifest_hash is set, compare content hash
+    and refresh recorded mtime, if content is the same.
+    """
+    if not recorded or "size" not in state:
+        return False
+    if any(
+        state[item] != recorded.get(item)
+        for item in ("source", "target", "size")
+    ):
+        return False
+    if state["mtime_ns"] == recorded.get("mtime_ns"):
+        return True
+    if manifest_hash and recorded.get("sha256"):
+        if get_file_hash(state["source"]) == recorded["sha256"]:
+            recorded["mtime_ns"] = state["mtime_ns"]
+            return True
+    return False
+
+
+def filter_unchanged(
+    selected_maps: dict, states: dict, manifest: dict
+) -> dict:
+    """
+    Remove file pairs not changed since last sync to current remote.
+
+    :param selected_maps: {file key: [source, target]}
+    :param states: Local states of selected files.
+    :param manifest: Manifest of current remote.
+    :return: {file key: [source, target]} of changed files.
+    """
+    return {
+        key: paths
+        for key, paths in selected_maps.items()
+        if not is_unchanged(states[key], manifest.get(key))
+    }
+
+
+def update_manifest(selected_maps: dict, states: dict, manifest: dict):
+    """
+    Record states of successfully synced files in manifest.
+    """
+    synced = {tuple(paths) for paths in synced_files}
+    for key, paths in selected_maps.items():
+        if tuple(paths) in synced and "size" in states[key]:
+            if manifest_hash:
+                states[key]["sha256"] = get_file_hash(states[key]["source"])
+            manifest[key] = states[key]
+    manifest_path.mkdir(parents=True, exist_ok=True)
+    write_yaml(
+        get_manifest_file(),
+        {"remote": f"{username}@{host}:{port}", "files": manifest},
+    )
+
+
+async def _restart_services():
     if not restart_services:
         return
     if not services:
@@ -273,10 +1175,19 @@ def _restart_services():
         LOGGER.info("No services specified for restart.")
         return
     print(f"{BLD}Restarting service(s) {' '.join(services)} on remote...{RST}")
-    run(
-        compose_ssh_command(ssh_config, (["systemctl", "restart"] + services)),
-        stdout=PIPE,
-    )
+    if transport == "agent":
+        try:
+            result = await asyncio.to_thread(get_agent().restart, services)
+        except OSError as err:
+            result = {"stderr": str(err)}
+        if result["stderr"]:
+            print(f"{RB}{result['stderr'].strip()}{RST}")
+    else:
+        await run_async(
+            compose_ssh_command(
+                ssh_config, (["systemctl", "restart"] + services)
+            )
+        )
     print(
         f"{BLD}Services restarted.{RST} (Check journalctl if restart was "
         f"successfull.)\n"
@@ -284,7 +1195,522 @@ def _restart_services():
     LOGGER.info(f"Restarted services: {' '.join(services)}")
 
 
-def _display_result_with_timeout():
+def open_ssh_master():
+    """
+    Open ssh master connection, which stays open until closed explicitly.
+    """
+    connection = get_ssh_connection(ssh_config)
+    if connection.persist != "yes":
+        # master may run with limited ControlPersist, replace it
+        connection.close()
+        connection.persist = "yes"
+    connection.open()
+
+
+def close_ssh_master():
+    get_ssh_connection(ssh_config).close()
+
+
+async def sync_burst(changed_maps: dict, manifest: dict):
+    """
+    Sync files changed during one burst of events and restart services
+    (once per burst), if requested.
+    """
+    print(f"{BLD}{strftime(date_format)} | changed: {len(changed_maps)}{RST}")
+    LOGGER.info("> WATCH SYNC <".center(50, "="))
+    LOGGER.info(f"timestamp: {strftime(date_format)}")
+    states = get_local_states(changed_maps) if use_manifest else {}
+    synced_files.clear()
+    i = await sync_maps_async(list(changed_maps.values()))
+    LOGGER.info(f"\nSynced file(s) count: {i - 1}")
+    if use_manifest:
+        update_manifest(changed_maps, states, manifest)
+    if i > 1:
+        await _restart_services()
+
+
+def watch_files(selected_maps: dict, manifest: dict):
+    """
+    Watch local sources of selected file pairs using inotify and sync them
+    as soon as they change. Events for the same file arriving within
+    watch_debounce seconds are coalesced into single transfer.
+
+    :param selected_maps: {file key: [source, target]}
+    :param manifest: Manifest of current remote.
+    """
+    watched = {}
+    for key, paths in selected_maps.items():
+        source = (Path(local_root_dir) / paths[0]).resolve()
+        watched.setdefault(source, []).append(key)
+    watcher = InotifyWatcher()
+    for dir_path in {source.parent for source in watched}:
+        try:
+            watcher.add_dir(dir_path)
+        except OSError as err:
+            print(f"{RB}{err}{RST}")
+    print(
+        f"{BLD}Watching {CB}{len(watched)}{RST}{BLD} file(s). "
+        f"Press Ctrl+C to stop.{RST}"
+    )
+    LOGGER.info(f"Watching file(s) count: {len(watched)}")
+    pending = {}
+    deadline = 0.0
+    try:
+        while True:
+            timeout = max(0.0, deadline - time()) if pending else None
+            for path, _ in watcher.read_events(timeout):
+                for key in watched.get(path, []):
+                    pending[key] = selected_maps[key]
+                    deadline = time() + watch_debounce
+            if pending and time() >= deadline:
+                asyncio.run(sync_burst(pending, manifest))
+                pending = {}
+    except KeyboardInterrupt:
+        print(f"\n{CB}Watch stopped.{RST}")
+    finally:
+        watcher.close()
+        if agent:
+            agent.close()
+        close_ssh_master()
+        LOGGER.info("".join(["> WATCH END <".center(50, "="), "\n\n"]))
+
+
+class ClientStream(TextIOBase):
+    """
+    Text stream sending everything written to it to daemon client
+    as JSON lines ({"out": text}). Disconnected client is ignored,
+    so request is always finished.
+    """
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+        self.connected = True
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.send({"out": text})
+        return len(text)
+
+    def send(self, message: dict):
+        if not self.connected:
+            return
+        try:
+            self.conn.sendall((json.dumps(message) + "\n").encode())
+        except OSError:
+            self.connected = False
+
+
+def reload_file_map():
+    """
+    Reload file map, if it was changed since it was loaded.
+    """
+    global file_map, all_maps, file_map_stamp
+    stamp = get_file_state(filemap_file)
+    if stamp != file_map_stamp:
+        file_map = FileMap(filemap_file)
+        all_maps = file_map.entries
+        file_map_stamp = stamp
+
+
+def get_request_maps(request: dict) -> dict:
+    """
+    Select file pairs requested by client: by local paths of files
+    (absolute, looked up in file map by source), keys, task or all.
+
+    :param request: Sync request.
+    :return: {file key: [source, target]}
+    """
+    if request.get("all"):
+        return dict(all_maps)
+    if request.get("task"):
+        if request["task"] not in file_map.tasks:
+            raise BadFileSyncDefinition(f"Task '{request['task']}' not found!")
+        return dict(get_task_maps(file_map, request["task"]))
+    selected = {}
+    for key in request.get("keys") or []:
+        if key not in file_map:
+            raise BadFileSyncDefinition(f"Item '{key}' not found!")
+        selected[key] = all_maps[key]
+    root = Path(local_root_dir).resolve()
+    for file in request.get("files") or []:
+        try:
+            source = Path(file).resolve().relative_to(root).as_posix()
+        except ValueError:
+            raise BadFileSyncDefinition(f"'{file}' is not in {root}!")
+        keys = file_map.keys_of(source)
+        if not keys:
+            raise BadFileSyncDefinition(f"'{source}' is not in file map!")
+        selected |= {key: all_maps[key] for key in keys}
+    return selected
+
+
+async def sync_request(selected_maps: dict) -> int:
+    """
+    Sync file pairs selected by client (unchanged ones are skipped,
+    unless forced) and restart services, if requested.
+
+    :return: Exit status of the request.
+    """
+    LOGGER.info("> DAEMON SYNC <".center(50, "="))
+    LOGGER.info(f"timestamp: {strftime(date_format)}")
+    for files in (synced_files, transferred_files, failed_files):
+        files.clear()
+    selected_maps, states, manifest = await asyncio.to_thread(
+        check_local_files, selected_maps
+    )
+    if not selected_maps:
+        print(f"{GB}All files are up to date.{RST}")
+        return 0
+    i = await synchronize_files(selected_maps)
+    print(f"{BLD}Synced {CB}{i - 1}{RST}{BLD} file(s).{RST}")
+    LOGGER.info(f"\nSynced file(s) count: {i - 1}")
+    if use_manifest:
+        update_manifest(selected_maps, states, manifest)
+    if i > 1:
+        await _restart_services()
+    return 1 if failed_files else 0
+
+
+def add_request(request: dict) -> int:
+    """
+    Add file to file map. Remote counterpart is given by client or found
+    in remote index kept in memory.
+
+    :return: Exit status of the request.
+    """
+    global remote_index, file_map_stamp
+    root = Path(local_root_dir).resolve()
+    try:
+        source = Path(request["source"]).resolve().relative_to(root)
+    except ValueError:
+        print(f"{RB}'{request['source']}' is not in {root}!{RST}")
+        return 1
+    task_name = request.get("task") or file_map.last_task()
+    if not task_name:
+        print(f"{RB}No task found in the file map! Provide a task name.{RST}")
+        return 1
+    if any(
+        file_map.task_of(key) == task_name
+        for key in file_map.keys_of(source.as_posix())
+    ):
+        print(f"{CB}'{source}' is already in task '{task_name}'!{RST}")
+        return 0
+    target = request.get("target")
+    if not target:
+        if remote_index is None:
+            remote_index = RemoteIndex(
+                ssh_config, default_browse_dir, remote_index_ttl
+            )
+        checked = remote_index.refresh()
+        candidates = remote_index.find(source.name)
+        if not candidates and not checked:
+            remote_index.refresh(max_age=0)
+            candidates = remote_index.find(source.name)
+        if len(candidates) > 1:
+            local_file = (root / source).as_posix()
+            picked = pick_by_content(
+                ssh_config, {local_file: candidates}, hash_cache
+            ).get(local_file)
+            hash_cache.save()
+            candidates = [picked] if picked else candidates
+        if len(candidates) != 1:
+            print(f"{RB}Can't decide remote file for '{source}'!{RST}")
+            for candidate in candidates:
+                print(f"    {candidate}")
+            print(f"{CB}Provide target of the file.{RST}")
+            return 1
+        target = candidates[0]
+    key = file_map.add(task_name, source.as_posix(), target)
+    file_map.save()
+    file_map_stamp = get_file_state(filemap_file)
+    print(f"{CB}Added '[{key}]: {source}' to task: '{task_name}'!{RST}")
+    return 0
+
+
+def view_request() -> int:
+    for task_name, paths in file_map.tasks.items():
+        print(f"[{task_name}]:")
+        for num, path in paths.items():
+            print(f"    [{num:2}]: {path[0]}")
+    return 0
+
+
+def check_request(request) -> str | None:
+    """
+    Check that request is JSON object with known op and fields, which
+    the op needs, of expected types.
+
+    :param request: Decoded request of client.
+    :return: Error message or None, if request is valid.
+    """
+    if not isinstance(request, dict):
+        return "Request must be JSON object!"
+    op = request.get("op")
+    if op not in REQUEST_FIELDS:
+        return f"Unknown request '{op}'!"
+    fields = REQUEST_FIELDS[op]
+    for field in REQUIRED_FIELDS.get(op, set()):
+        if request.get(field) is None:
+            return f"Request '{op}' requires '{field}'!"
+    for field, value in request.items():
+        if field == "op" or value is None:
+            continue
+        if field not in fields:
+            return f"Unknown field '{field}' of request '{op}'!"
+        if not isinstance(value, fields[field]) or (
+            field in LIST_ITEMS
+            and not all(type(item) is LIST_ITEMS[field] for item in value)
+        ):
+            return f"Invalid value of '{field}' in request '{op}'!"
+    return None
+
+
+def handle_request(request: dict) -> int:
+    """
+    Handle single client request.
+
+    :param request: Valid request (see check_request),
+                    {"op": "sync" | "add" | "view" | "status", ...}
+    :return: Exit status of the request.
+    """
+    global force
+    reload_file_map()
+    op = request.get("op")
+    if op == "sync":
+        # master may have died since the last request
+        if not get_ssh_connection(ssh_config).is_alive():
+            open_ssh_master()
+        force = request.get("force") or args.force
+        return asyncio.run(sync_request(get_request_maps(request)))
+    if op == "add":
+        return add_request(request)
+    if op == "view":
+        return view_request()
+    print(
+        f"pid: {os.getpid()}, remote: {username}@{host}:{port}, "
+        f"file map: {filemap_file} ({len(all_maps)} items), "
+        f"requests: {served_requests}"
+    )
+    return 0
+
+
+def restart_daemon(server: socket.socket, socket_path: Path):
+    """
+    Replace running daemon by new one with the same arguments (ssh master
+    keeps running and is reused).
+    """
+    print(f"{CB}Config changed, restarting daemon...{RST}")
+    LOGGER.info("Daemon restarted: config changed.")
+    server.close()
+    socket_path.unlink(missing_ok=True)
+    os.execv(
+        sys.executable,
+        [sys.executable, Path(__file__).resolve().as_posix()] + sys.argv[1:],
+    )
+
+
+def serve_client(conn: socket.socket) -> bool:
+    """
+    Read request of connected client and stream output of its handling
+    back to it.
+
+    :return: True if client asked daemon to stop.
+    """
+    global served_requests
+    # client, which doesn't send or read, must not block the daemon
+    conn.settimeout(10.0)
+    stream = ClientStream(conn)
+    with conn, conn.makefile("rb") as reader:
+        try:
+            request = json.loads(reader.readline() or "{}")
+        except (OSError, ValueError):
+            request = None
+        stop = False
+        with redirect_stdout(stream):
+            try:
+                error = check_request(request)
+                if error:
+                    print(f"{RB}{error}{RST}")
+                    status = 2
+                elif request["op"] == "stop":
+                    stop = True
+                    status = 0
+                else:
+                    status = handle_request(request)
+            except (
+                BadFileSyncDefinition,
+                RepeatingKeyError,
+                RsyncError,
+                OSError,
+            ) as err:
+                print(f"{RB}{err}{RST}")
+                status = 1
+            except SystemExit as err:
+                # failed request must not stop the daemon
+                status = err.code if isinstance(err.code, int) else 1
+            except Exception as err:
+                LOGGER.exception(f"Daemon request {request} failed:")
+                print(f"{RB}Request failed: {err!r}{RST}")
+                status = 1
+        served_requests += 1
+        stream.send({"exit": status})
+    return stop
+
+
+def serve():
+    """
+    Run as resident daemon serving requests of syncsuite.py client over
+    Unix socket (JSON line request, JSON lines with output and exit status
+    in response). ssh master, file map and remote index stay warm between
+    requests. Changed file map is reloaded before next request, changed
+    config restarts the daemon.
+    """
+    socket_path = Path(args.socket or daemon_socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        if probe.connect_ex(str(socket_path)) == 0:
+            print(f"{RB}Daemon is already running on {socket_path}!{RST}")
+            exit(1)
+    # socket left behind by dead daemon would block new one
+    socket_path.unlink(missing_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_path))
+    socket_path.chmod(0o600)
+    server.listen()
+    # config changes are checked also while waiting for requests
+    server.settimeout(1.0)
+    # SIGTERM stops daemon like Ctrl+C (SystemExit is caught per request)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    config_stamp = get_file_state(config_file) if config_file else None
+    open_ssh_master()
+    print(
+        f"{BLD}Daemon serving {CB}{username}@{host}:{port}{RST}{BLD} "
+        f"on {socket_path}. Press Ctrl+C to stop.{RST}"
+    )
+    LOGGER.info(f"Daemon started: {username}@{host}:{port} on {socket_path}")
+    stop = False
+    try:
+        while not stop:
+            try:
+                stop = serve_client(server.accept()[0])
+            except TimeoutError:
+                pass
+            if config_file and get_file_state(config_file) != config_stamp:
+                restart_daemon(server, socket_path)
+    except KeyboardInterrupt:
+        print(f"\n{CB}Daemon stopped.{RST}")
+    finally:
+        server.close()
+        socket_path.unlink(missing_ok=True)
+        if agent:
+            agent.close()
+        close_ssh_master()
+        LOGGER.info("".join(["> DAEMON END <".center(50, "="), "\n\n"]))
+
+
+def write_fanout_summary(seconds: float):
+    """
+    Write summary of this run for the parent process syncing multiple hosts.
+    """
+    if not args.fanout_summary:
+        return
+    transferred_bytes = sum(
+        get_file_state(Path(local_root_dir) / paths[0]).get("size", 0)
+        for paths in transferred_files
+    )
+    with open(args.fanout_summary, "w") as f:
+        json.dump(
+            {
+                "transferred": len(transferred_files),
+                "failed": len(failed_files),
+                "bytes": transferred_bytes,
+                "seconds": seconds,
+            },
+            f,
+        )
+
+
+def sync_host(remote: str, summary_dir: str) -> tuple[str, int, dict]:
+    """
+    Run this script for single host in subprocess. Interactive timeouts
+    are disabled, output is captured and printed by the caller.
+
+    :param remote: Remote host.
+    :param summary_dir: Directory for summary file of the run.
+    :return: Output, return code and summary of the run.
+    """
+    summary_file = Path(summary_dir) / f"{remote}.json"
+    # later occurrence of an argument overrides the previous one
+    result = run(
+        [sys.executable, Path(__file__).resolve().as_posix()]
+        + sys.argv[1:]
+        + ["-r", remote, "-vt", "0", "-rt", "0"]
+        + ["--fanout_summary", summary_file.as_posix()],
+        stdout=PIPE,
+        stderr=STDOUT,
+        text=True,
+    )
+    summary = {}
+    if summary_file.exists():
+        summary = json.loads(summary_file.read_text())
+    return result.stdout, result.returncode, summary
+
+
+def fan_out():
+    """
+    Sync selected files to all hosts in parallel. Each host runs in its own
+    process with its own ssh ControlMaster socket and restarts its services
+    as soon as its own sync is finished.
+    """
+    start_time = time()
+    print(f"{BLD}Syncing to {CB}{len(hosts)}{RST}{BLD} hosts...{RST}")
+    LOGGER.info(f"Fan-out to hosts: {', '.join(hosts)}")
+    results = {}
+    with (
+        TemporaryDirectory() as summary_dir,
+        ThreadPoolExecutor(max_workers=len(hosts)) as pool,
+    ):
+        futures = {
+            pool.submit(sync_host, remote, summary_dir): remote
+            for remote in hosts
+        }
+        for future in as_completed(futures):
+            remote = futures[future]
+            output, returncode, summary = future.result()
+            print("".join([BLD, f"> {remote} <".center(80, "-"), RST]))
+            print(output)
+            results[remote] = (returncode, summary)
+
+    print("".join([BLD, "> Fan-out summary <".center(80, "="), RST]))
+    failed_hosts = 0
+    for remote in hosts:
+        returncode, summary = results[remote]
+        if not summary:
+            failed_hosts += 1
+            print(f"{RB}{remote}: run failed (exit code {returncode}){RST}")
+            LOGGER.info(f"{remote}: run failed (exit code {returncode})")
+            continue
+        seconds = summary["seconds"] or 1e-9
+        throughput = summary["bytes"] / seconds / 1024**2
+        color = RB if summary["failed"] else GB
+        line = (
+            f"{remote}: {summary['transferred']} synced, "
+            f"{summary['failed']} failed, {summary['bytes']} B in "
+            f"{summary['seconds']:.2f} s ({throughput:.2f} MiB/s)"
+        )
+        failed_hosts += bool(summary["failed"])
+        print(f"{color}{line}{RST}")
+        LOGGER.info(line)
+    print(
+        f"{BLD}\nFinished {CB}{len(hosts)}{RST}{BLD} hosts in "
+        f"{CB}{(time() - start_time):.2f} seconds{RST}{BLD}.{RST}\n"
+    )
+    asyncio.run(_display_result_with_timeout())
+    exit(1 if failed_hosts else 0)
+
+
+async def _display_result_with_timeout():
     if result_timeout:
         for x in range(result_timeout):
             print(
@@ -292,50 +1718,148 @@ def _display_result_with_timeout():
                 f"in: {(result_timeout - x)} s...{RST}",
                 end=" \r",
             )
-            sleep(1)
+            await asyncio.sleep(1)
 
 
-def main():
+def check_local_files(selected_maps: dict) -> tuple[dict, dict, dict]:
+    """
+    Read manifest and remove file pairs unchanged since last sync.
+
+    :param selected_maps: {file key: [source, target]}
+    :return: Changed file pairs, their local states and manifest.
+    """
+    manifest = states = {}
+    if use_manifest:
+        manifest = read_manifest()
+        if changed_only:
+            changed_maps = filter_git_changed(selected_maps, manifest)
+            skipped = len(selected_maps) - len(changed_maps)
+            if skipped:
+                print(f"{CB}{skipped} file(s) not changed in git.{RST}")
+                LOGGER.info(f"Not changed in git file(s) count: {skipped}")
+            selected_maps = changed_maps
+        states = get_local_states(selected_maps)
+        if not force:
+            changed_maps = filter_unchanged(selected_maps, states, manifest)
+            skipped = len(selected_maps) - len(changed_maps)
+            if skipped:
+                print(f"{CB}Skipping {skipped} unchanged file(s).{RST}")
+                LOGGER.info(f"Skipped unchanged file(s) count: {skipped}")
+            selected_maps = changed_maps
+    return selected_maps, states, manifest
+
+
+async def connect() -> str:
+    """
+    Open persistent SSH connection (if used) and fetch remote hostname.
+    """
+    timer = PhaseTimer()
+    with timer.phase("master"):
+        if watch:
+            await asyncio.to_thread(open_ssh_master)
+        elif persistent_ssh:
+            await asyncio.to_thread(get_ssh_connection(ssh_config).open)
+    if transport == "agent":
+        # agent started here serves the rest of the session
+        try:
+            with timer.phase("agent"):
+                hostname = await asyncio.to_thread(
+                    lambda: get_agent().hostname()
+                )
+            status = 0
+        except OSError as err:
+            print(f"{RB}{err}{RST}")
+            hostname, status = "", 1
+        metrics.record("ssh_connect", timer, files=0, exit_status=status)
+        return hostname
+    result = await run_async(
+        compose_ssh_command(ssh_config, ["hostname"]), timer=timer
+    )
+    metrics.record(
+        "ssh_connect", timer, files=0, exit_status=result.returncode
+    )
+    if result.returncode != 0 and result.stderr:
+        print(f"{RB}{result.stderr.strip()}{RST}")
+    return result.stdout
+
+
+async def check_vm() -> bool:
+    """
+    Give user few seconds to check VM settings.
+
+    :return: False if synchronization was canceled by user.
+    """
+    if not VM_check_timeout:
+        return True
+    from pytimedinput import timedKey
+
+    user_text, timed_out = await asyncio.to_thread(
+        timedKey,
+        f"Correct VM? (Waiting for {VM_check_timeout} s.) [y/n]: ",
+        timeout=VM_check_timeout,
+        allowCharacters="yYnN",
+    )
+    if timed_out:
+        print("Continue synchronization!")
+        LOGGER.info("VM check: OK! (w/o user interaction)")
+        return True
+    if user_text in ["y", "Y"]:
+        LOGGER.info("VM check: OK!")
+        return True
+    print("Synchronization canceled. Check WM info.")
+    LOGGER.info("VM check: Synchronization canceled by user.")
+    return False
+
+
+async def main_async() -> tuple[int | None, dict, dict]:
+    """
+    Sync selected files. Local files are checked against manifest first,
+    so SSH connection is opened only if there is something to sync
+    (or in watch mode). Transfers run with bounded concurrency and
+    services are restarted as soon as the last file lands.
+
+    :return: Exit status, if the run ends without sync (None otherwise),
+             selected file pairs and manifest (for watch mode).
+    """
     start_time = time()
     print("".join([BLD, "> Sync files to remote VM <".center(80, "="), RST]))
     LOGGER.info("> SYNC START <".center(50, "="))
     LOGGER.info(f"timestamp: {strftime(date_format)}")
-    # display info about VM and open persistent SSH connection
+    selected_maps = watched_maps = get_selected_maps(all_maps)
+    selected_maps, states, manifest = await asyncio.to_thread(
+        check_local_files, selected_maps
+    )
+    if not selected_maps:
+        print(f"{GB}All files are up to date.{RST}")
+        # store mtimes refreshed by hash comparison
+        if use_manifest:
+            update_manifest(selected_maps, states, manifest)
+        if not watch:
+            LOGGER.info("".join(["> SYNC END <".center(50, "="), "\n\n"]))
+            # nothing was transferred, so services are not restarted
+            write_fanout_summary(time() - start_time)
+            return 0, watched_maps, manifest
+    # display info about VM
     print(f"{BLD}ssh: {RB}{username}@{host}:{port}{RST}")
     LOGGER.info(f"ssh: {username}@{host}:{port}")
     print("Fetching remote hostname...")
-    hostname = run(
-        compose_ssh_command(ssh_config, ["hostname"]),
-        stdout=PIPE,
-    ).stdout.decode("utf-8")
+    hostname = await connect()
     print(f"{BLD}remote hostname: {RB}{hostname}{RST}")
     LOGGER.info(f"remote hostname: {hostname.strip()}")
 
-    # give user few seconds to check VM settings
-    if VM_check_timeout:
-        user_text, timed_out = timedKey(
-            f"Correct VM? (Waiting for {VM_check_timeout} s.) [y/n]: ",
-            timeout=VM_check_timeout,
-            allowCharacters="yYnN",
-        )
-        if timed_out:
-            print("Continue synchronization!")
-            LOGGER.info("VM check: OK! (w/o user interaction)")
-            i = synchronize_files(all_maps)
-        else:
-            if user_text in ["y", "Y"]:
-                LOGGER.info("VM check: OK!")
-                i = synchronize_files(all_maps)
-            else:
-                print("Synchronization canceled. Check WM info.")
-                LOGGER.info("VM check: Synchronization canceled by user.")
-                LOGGER.info("".join(["> SYNC END <".center(50, "="), "\n\n"]))
-                exit(1)
-    else:
-        i = synchronize_files(all_maps)
+    if not await check_vm():
+        LOGGER.info("".join(["> SYNC END <".center(50, "="), "\n\n"]))
+        return 1, watched_maps, manifest
+    i = await synchronize_files(selected_maps)
+    # services are restarted only if something was transferred
+    restarting = asyncio.create_task(
+        _restart_services() if i > 1 else asyncio.sleep(0)
+    )
 
     end_time = time()
-    if i == 1:
+    if i == 1 and not selected_maps:
+        print(f"{GB}Waiting for changes...{RST}\n")
+    elif i == 1:
         print(f"{RB}\nSynced {i - 1} file!{RST}\n")
     else:
         plural = "s" if i > 2 else ""
@@ -344,11 +1868,47 @@ def main():
             f"{CB}{(end_time - start_time):.2f} seconds{RST}{BLD}.{RST}\n"
         )
     LOGGER.info(f"\nSynced file(s) count: {i - 1}")
+    if metrics.latencies:
+        summary = metrics.summary()
+        print(
+            f"Per-file latency p50: {CB}{summary['p50']:.3f} s{RST}, "
+            f"p95: {CB}{summary['p95']:.3f} s{RST}\n"
+        )
+        LOGGER.info(
+            f"Per-file latency p50: {summary['p50']:.3f} s, "
+            f"p95: {summary['p95']:.3f} s"
+        )
     LOGGER.info("".join(["> SYNC END <".center(50, "="), "\n\n"]))
+    if use_manifest and selected_maps:
+        await asyncio.to_thread(
+            update_manifest, selected_maps, states, manifest
+        )
+    write_fanout_summary(end_time - start_time)
+
+    if watch:
+        await restarting
+    else:
+        await asyncio.gather(restarting, _display_result_with_timeout())
+    return None, watched_maps, manifest
 
-    _restart_services()
 
-    _display_result_with_timeout()
+def main():
+    if daemon:
+        serve()
+        exit(0)
+    if len(hosts) > 1:
+        fan_out()
+    try:
+        status, watched_maps, manifest = asyncio.run(main_async())
+        if status is not None:
+            exit(status)
+        if watch:
+            watch_files(watched_maps, manifest)
+    except RsyncError as err:
+        print(f"{RB}{err}{RST}")
+        exit(1)
+    if agent:
+        agent.close()
 
     print(f"{GB}GoodBye!{RST}", " " * 70)
     sleep(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env /home/marpauli/.cache/pypoetry/virtualenvs/syncsuite-HX8knUdy-py3.12/bin/python
+
+"""
+Thin client of resident rsync_to_remote daemon (started with -D).
+Request is sent over Unix socket and output of the daemon is printed as it
+comes, so editor hooks and scripts can sync single file without paying for
+startup of rsync_to_remote, loading of config and file map or opening
+ssh connection.
+"""
+
+import json
+import socket
+from argparse import RawDescriptionHelpFormatter
+from pathlib import Path
+
+from common import CB, RB, RST, CustomArgParser, daemon_socket_path
+
+# setup arg parser
+help_message = """
+    Send request to rsync_to_remote daemon (rsync_to_remote.py -D).
+    Files given by path are looked up in file map by their source.
+    Without any option, files are synced."""
+cap = CustomArgParser(
+    description=help_message,
+    formatter_class=RawDescriptionHelpFormatter,
+)
+
+cap.add_argument("files", nargs="*", help="Local files to sync")
+cap.add_argument("-t", "--task", help="Sync task (or add file to task)")
+cap.add_argument(
+    "-f", "--file_keys", help="Sync selected keys. No spaces, comma separated."
+)
+cap.add_argument(
+    "-a", "--sync_all", help="Sync all files", action="store_true"
+)
+cap.add_argument(
+    "-fo",
+    "--force",
+    help="Sync files even if they didn't change since last sync",
+    action="store_true",
+)
+cap.add_argument("-ad", "--add", metavar="FILE", help="Add file to file map")
+cap.add_argument(
+    "-tg", "--target", help="Remote path of added file (found by default)"
+)
+cap.add_argument(
+    "-v", "--view", help="List items of file map", action="store_true"
+)
+cap.add_argument(
+    "-st", "--status", help="Show status of daemon", action="store_true"
+)
+cap.add_argument("-q", "--quit", help="Stop daemon", action="store_true")
+cap.add_argument("-so", "--socket", help="Path to Unix socket of the daemon")
+
+args = cap.parse_args()
+
+
+def get_request() -> dict:
+    if args.quit:
+        return {"op": "stop"}
+    if args.status:
+        return {"op": "status"}
+    if args.view:
+        return {"op": "view"}
+    if args.add:
+        return {
+            "op": "add",
+            "source": Path(args.add).resolve().as_posix(),
+            "task": args.task,
+            "target": args.target,
+        }
+    if not any([args.files, args.task, args.file_keys, args.sync_all]):
+        cap.error(f"{RB}Specify files, keys, task or all to sync!{RST}")
+    try:
+        keys = [int(key) for key in (args.file_keys or "").split(",") if key]
+    except ValueError:
+        cap.error(f"{RB}Invalid file keys provided! Use integers only.{RST}")
+    return {
+        "op": "sync",
+        # daemon runs in other working dir
+        "files": [Path(file).resolve().as_posix() for file in args.files],
+        "keys": keys,
+        "task": args.task,
+        "all": args.sync_all,
+        "force": args.force,
+    }
+
+
+def main():
+    request = get_request()
+    socket_path = Path(args.socket or daemon_socket_path)
+    status = 1
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(str(socket_path))
+        except OSError:
+            print(
+                f"{RB}Daemon is not running on {socket_path}!{RST}\n"
+                f"{CB}Start it with 'rsync_to_remote.py -D'.{RST}"
+            )
+            exit(1)
+        conn.sendall((json.dumps(request) + "\n").encode())
+        with conn.makefile("rb") as reader:
+            for line in reader:
+                message = json.loads(line)
+                if "out" in message:
+                    print(message["out"], end="", flush=True)
+                else:
+                    status = message["exit"]
+    exit(status)
+
+
+if __name__ == "__main__":
+    main()